@@ -0,0 +1,200 @@
+import time
+import asyncio
+import logging
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+
+class SbFeedAsyncRuntime:
+    def __init__(self, fetcher, notifier, bot, events, *, workers,
+                 cleanup, cleanup_interval, poll_updates=True,
+                 poll_timeout=30, min_wait=1, idle_wait=300):
+        self.fetcher = fetcher
+        self.notifier = notifier
+        self.bot = bot
+        self.events = events
+        self.model = fetcher.model
+        self.workers = workers
+        self.cleanup = cleanup
+        self.cleanup_interval = cleanup_interval
+        # with a webhook updates arrive on its own threads
+        self.poll_updates = poll_updates
+        self.poll_timeout = poll_timeout
+        self.min_wait = min_wait
+        self.idle_wait = idle_wait
+        self.logger = logging.getLogger('sbfeed.aio')
+        self.tasks = set()
+
+    def run(self):
+        asyncio.run(self._main())
+
+    async def _main(self):
+        self.loop = asyncio.get_running_loop()
+        # blocking network, parsing and database calls run here
+        self.executor = ThreadPoolExecutor(max_workers=self.workers,
+                                           thread_name_prefix='aio')
+        self.loop.set_default_executor(self.executor)
+        loops = [self._fetch_loop(), self._notify_loop(),
+                 self._cleanup_loop()]
+        if self.poll_updates:
+            loops.append(self._update_loop())
+        try:
+            await asyncio.gather(*loops)
+        finally:
+            self.executor.shutdown(wait=False)
+
+    def _run(self, func, *args):
+        return self.loop.run_in_executor(None, func, *args)
+
+    def _spawn(self, coro):
+        # the loop only keeps weak references to tasks
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    def _watch(self, signal):
+        event = asyncio.Event()
+        signal.subscribe(lambda: self.loop.call_soon_threadsafe(event.set))
+        return event
+
+    async def _wait(self, event, timeout):
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        event.clear()
+
+    async def _fetch_loop(self):
+        feeds_changed = self._watch(self.events.feeds_changed)
+        # keep the executor for the other loops: fetches take at most
+        # half of it, and no more than allowed per host
+        slots = asyncio.Semaphore(max(1, self.workers // 2))
+        host_limits = collections.defaultdict(
+            lambda: asyncio.Semaphore(self.fetcher.per_host)
+        )
+        in_flight = set()
+
+        async def fetch(row):
+            try:
+                async with host_limits[self.fetcher.host(row[0])]:
+                    await self._run(self.fetcher.process_feed, *row)
+            except Exception:
+                self.logger.exception('failed to process feed %r', row[0])
+            finally:
+                in_flight.discard(row[0])
+                slots.release()
+                # the feed counts for the next fetch time again
+                feeds_changed.set()
+
+        while True:
+            for row in await self._run(self.model.get_fetches_needed,
+                                       self.fetcher.shards()):
+                if row[0] in in_flight:
+                    continue
+                await slots.acquire()
+                in_flight.add(row[0])
+                self._spawn(fetch(row))
+            next_fetch = await self._run(self.fetcher.next_fetch_time,
+                                         set(in_flight))
+            if next_fetch is None:
+                timeout = self.idle_wait
+            else:
+                timeout = min(max(next_fetch - time.time(), self.min_wait),
+                              self.idle_wait)
+            await self._wait(feeds_changed, timeout)
+
+    async def _notify_loop(self):
+        items_stored = self._watch(self.events.items_stored)
+        notifier = self.notifier
+        while True:
+            try:
+                items = await self._run(notifier.next_batch)
+                if items:
+                    await self._run(notifier.enqueue, items)
+                messages = await self._run(notifier.claim)
+            except Exception:
+                self.logger.exception('failed to get notifications')
+                items = messages = None
+            if not items and not messages:
+                await self._wait(items_stored,
+                                 notifier.wait_time(self.idle_wait))
+                continue
+            if not messages:
+                continue
+            by_chat = await self._run(notifier.group_by_chat, messages)
+            results = await asyncio.gather(*[self._deliver_chat(messages)
+                                             for messages in by_chat])
+            await self._run(notifier.complete_delivery,
+                            [result for chat_results in results
+                             for result in chat_results])
+
+    async def _deliver_chat(self, messages):
+        notifier = self.notifier
+        results = []
+        for message in messages:
+            try:
+                outcome = await self._deliver(message)
+            except Exception:
+                self.logger.exception('failed to deliver %r', message)
+                outcome = notifier.FAILED
+            results.append((message, outcome))
+            if outcome not in notifier.DELIVERED:
+                results.extend((rest, notifier.DEFERRED)
+                               for rest in messages[len(results):])
+                break
+        return results
+
+    async def _deliver(self, message):
+        notifier = self.notifier
+        for attempt in range(notifier.MAX_ATTEMPTS):
+            await asyncio.sleep(
+                notifier.chat_bucket(message['chat_id']).reserve()
+            )
+            await asyncio.sleep(notifier.global_bucket.reserve())
+            outcome = await self._run(notifier.send, message)
+            if outcome != notifier.RETRY:
+                return outcome
+        self.logger.warning('hit flood control in chat %d %d times in a row',
+                            message['chat_id'], attempt + 1)
+        return notifier.FAILED
+
+    async def _update_loop(self):
+        dispatcher = self.bot.dispatcher
+        # Updater.start_polling() does this too: telegram refuses
+        # get_updates while a webhook, e.g. of an earlier run, is set
+        while True:
+            try:
+                await self._run(
+                    lambda: dispatcher.bot.setWebhook(webhook_url='')
+                )
+            except Exception:
+                self.logger.exception('failed to remove the webhook')
+                await asyncio.sleep(self.min_wait)
+                continue
+            break
+        offset = None
+        while True:
+            try:
+                updates = await self._run(
+                    lambda: dispatcher.bot.get_updates(
+                        offset=offset, timeout=self.poll_timeout
+                    )
+                )
+            except Exception:
+                self.logger.exception('failed to get updates')
+                await asyncio.sleep(self.min_wait)
+                continue
+            for update in updates:
+                offset = update.update_id + 1
+                self._spawn(self._process_update(update))
+
+    async def _process_update(self, update):
+        try:
+            await self._run(self.bot.dispatcher.process_update, update)
+        except Exception:
+            self.logger.exception('failed to process update %r', update)
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            await self._run(self.cleanup)
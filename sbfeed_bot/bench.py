@@ -0,0 +1,377 @@
+import os
+import re
+import sys
+import json
+import time
+import random
+import logging
+import argparse
+import resource
+import tempfile
+import threading
+import multiprocessing
+from email.utils import formatdate
+from urllib.parse import parse_qs
+from urllib.request import urlopen
+from xml.sax.saxutils import escape
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot.feed import SbFeedFeeder
+from sbfeed_bot.model import SbFeedModel
+from sbfeed_bot.events import SbFeedEvents
+from sbfeed_bot.fetcher import SbFeedFetcher
+from sbfeed_bot.notifier import SbFeedNotifier
+from sbfeed_bot.schedule import SbFeedSchedule
+from sbfeed_bot.storage import shard_key
+from sbfeed_bot.main import start_threads, peridodic_fetcher, periodic_notifier
+
+
+TOKEN = '123456:' + 'B' * 35
+# every comment link carries its creation time, so that the fake
+# telegram can tell the comment-to-delivery latency
+CREATED_RE = re.compile(r'[?&]created=([0-9.]+)')
+
+
+class FakeSongbook:
+    # serves rss of gigs gig-0 .. gig-N, adding comments at random
+    FEED_LENGTH = 50
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.feeds = 0
+        self.churn = 0
+        self.comments = {}
+        self.created = 0
+
+    def reset(self, feeds):
+        with self.lock:
+            self.feeds = feeds
+            self.churn = 0
+            self.comments = {}
+            self.created = 0
+
+    def add_comment(self, base_url):
+        slug = 'gig-%d' % (random.randrange(self.feeds), )
+        now = time.time()
+        with self.lock:
+            comments = self.comments.setdefault(slug, [])
+            # pubdate is in seconds and unique within a feed
+            pubdate = max(int(now), comments[-1][0] + 1 if comments else 0)
+            comments.append((pubdate, '%s/gig/%s/?created=%.6f'
+                             % (base_url, slug, now)))
+            del comments[:-self.FEED_LENGTH]
+            self.created += 1
+
+    def churn_forever(self, base_url):
+        while True:
+            if self.churn:
+                self.add_comment(base_url)
+                time.sleep(random.expovariate(self.churn))
+            else:
+                time.sleep(0.1)
+
+    def render(self, slug):
+        with self.lock:
+            comments = list(self.comments.get(slug, ()))
+        build_date = comments[-1][0] if comments else 1000000000
+        items = ''.join(
+            '<item><title>comment %d</title><link>%s</link>'
+            '<description>&lt;pre&gt;%s&lt;/pre&gt;</description>'
+            '<pubDate>%s</pubDate></item>'
+            % (pubdate, escape(link), 'lorem ipsum ' * 20,
+               formatdate(pubdate).replace('-0000', '+0000'))
+            for pubdate, link in reversed(comments)
+        )
+        return build_date, (
+            '<?xml version="1.0"?><rss><channel><title>%s</title>'
+            '<lastBuildDate>%s</lastBuildDate>%s</channel></rss>'
+            % (slug, formatdate(build_date).replace('-0000', '+0000'), items)
+        ).encode('utf-8')
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.messages = 0
+            self.latencies = []
+
+    def send_message(self, params):
+        now = time.time()
+        created = CREATED_RE.findall(params.get('text', ''))
+        with self.lock:
+            self.messages += 1
+            self.latencies.extend(now - float(stamp) for stamp in created)
+            message_id = self.messages
+        return {'message_id': message_id, 'date': int(now),
+                'chat': {'id': int(params['chat_id']), 'type': 'private'},
+                'text': params.get('text', '')}
+
+    def stats(self):
+        with self.lock:
+            return {'messages': self.messages,
+                    'latencies': list(self.latencies)}
+
+
+class FakesHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self, status, body, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _reply_json(self, data):
+        self._reply(200, json.dumps(data).encode('utf-8'),
+                    [('Content-Type', 'application/json')])
+
+    def do_GET(self):
+        songbook = self.server.songbook
+        if self.path.startswith('/comments/feeds/'):
+            slug = self.path[len('/comments/feeds/'):]
+            build_date, body = songbook.render(slug)
+            etag = '"%d"' % (build_date, )
+            if self.headers.get('If-None-Match') == etag:
+                self._reply(304, b'', [('ETag', etag)])
+            else:
+                self._reply(200, body, [('ETag', etag),
+                                        ('Content-Type', 'application/xml')])
+        elif self.path == '/stats':
+            stats = self.server.telegram.stats()
+            stats['created'] = songbook.created
+            self._reply_json(stats)
+        else:
+            self._reply(404, b'not found\n')
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path.startswith(('/reset?', '/churn?')):
+            query = parse_qs(self.path.split('?', 1)[1])
+            if 'feeds' in query:
+                self.server.songbook.reset(int(query['feeds'][0]))
+                self.server.telegram.reset()
+            if 'rate' in query:
+                self.server.songbook.churn = float(query['rate'][0])
+            self._reply_json({'ok': True})
+            return
+        method = self.path.rsplit('/', 1)[-1]
+        if 'json' in self.headers.get('Content-Type', ''):
+            params = json.loads(body or b'{}')
+        else:
+            params = {key: values[0] for key, values
+                      in parse_qs(body.decode('utf-8')).items()}
+        if method == 'sendMessage':
+            result = self.server.telegram.send_message(params)
+        elif method == 'getMe':
+            result = {'id': 1, 'first_name': 'bench', 'username': 'bench'}
+        elif method == 'getUpdates':
+            result = []
+        else:
+            result = True
+        self._reply_json({'ok': True, 'result': result})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class FakesServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # the bot process is killed at the end of every run
+        pass
+
+
+def serve_fakes(port, ready):
+    server = FakesServer(('127.0.0.1', port), FakesHandler)
+    server.songbook = FakeSongbook()
+    server.telegram = FakeTelegram()
+    base_url = 'http://127.0.0.1:%d' % (server.server_address[1], )
+    threading.Thread(target=server.songbook.churn_forever, args=(base_url, ),
+                     daemon=True).start()
+    ready.send(server.server_address[1])
+    server.serve_forever()
+
+
+def populate(model, feeds, subscriptions):
+    now = int(time.time())
+    with model._connection() as conn:
+        conn.execute("BEGIN")
+        conn.executemany(
+            "INSERT INTO feed (slug, created, shard_key) VALUES (?, ?, ?)",
+            [('gig-%d' % (feed, ), now, shard_key('gig-%d' % (feed, )))
+             for feed in range(feeds)]
+        )
+        conn.executemany(
+            "INSERT INTO subscription (chat_id, feed, last_notified) "
+            "VALUES (?, ?, ?)",
+            [(chat_id, 'gig-%d' % (chat_id % feeds, ), now - 1)
+             for chat_id in range(1, subscriptions + 1)]
+        )
+        conn.execute("COMMIT")
+
+
+def current_rss():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run_bot(config, subscriptions, control):
+    # runs in its own process, so that memory is measured per scale
+    feeds = max(1, subscriptions // config.subscriptions_per_feed)
+    dbfile = os.path.join(config.workdir, 'bench-%d.db' % (subscriptions, ))
+    events = SbFeedEvents()
+    model = SbFeedModel(dbfile, events=events, schedule=SbFeedSchedule(
+        min_interval=config.poll_interval, max_interval=config.poll_interval
+    ))
+    model.create_db()
+    populate(model, feeds, subscriptions)
+    feeder = SbFeedFeeder(config.url, pool_size=config.fetch_concurrency)
+    fetcher = SbFeedFetcher(feeder, model,
+                            concurrency=config.fetch_concurrency,
+                            per_host=config.fetch_concurrency)
+    bot = SbFeedBot(TOKEN, model, feeder, base_url=config.url + '/bot')
+    notifier = SbFeedNotifier(model, bot,
+                              concurrency=config.notify_concurrency,
+                              rate=config.notify_rate,
+                              batch_size=config.notify_batch_size,
+                              digest_window=config.digest_window)
+    start_threads([
+        threading.Thread(name='fetcher', target=peridodic_fetcher,
+                         args=(fetcher, events)),
+        threading.Thread(name='notifier', target=periodic_notifier,
+                         args=(notifier, events)),
+    ])
+    control.send('ready')
+    control.recv()
+    # gigs start empty, so every stored item is a comment made during the run
+    with model._connection() as conn:
+        [ingested] = conn.execute(
+            "SELECT count(*) FROM feed_item"
+        ).fetchone()
+    control.send({'ingested': ingested,
+                  'rss': current_rss(),
+                  'max_rss': resource.getrusage(
+                      resource.RUSAGE_SELF).ru_maxrss * 1024})
+
+
+def percentile(values, fraction):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def control(url, path):
+    urlopen(url + path, data=b'').read()
+
+
+def run_scale(config, subscriptions):
+    feeds = max(1, subscriptions // config.subscriptions_per_feed)
+    control(config.url, '/reset?feeds=%d' % (feeds, ))
+    context = multiprocessing.get_context('spawn')
+    parent, child = context.Pipe()
+    process = context.Process(target=run_bot,
+                              args=(config, subscriptions, child))
+    process.start()
+    try:
+        parent.recv()
+        control(config.url, '/churn?rate=%f' % (config.churn, ))
+        time.sleep(config.duration)
+        control(config.url, '/churn?rate=0')
+        time.sleep(config.drain)
+        parent.send('report')
+        report = parent.recv()
+        stats = json.loads(urlopen(config.url + '/stats').read())
+    finally:
+        process.terminate()
+        process.join()
+    elapsed = config.duration + config.drain
+    return {
+        'subscriptions': subscriptions,
+        'feeds': feeds,
+        'comments': stats['created'],
+        'items_per_sec': report['ingested'] / config.duration,
+        'notifications_per_sec': len(stats['latencies']) / elapsed,
+        'messages': stats['messages'],
+        'p50': percentile(stats['latencies'], 0.5),
+        'p99': percentile(stats['latencies'], 0.99),
+        'rss_mb': report['rss'] / 2 ** 20,
+        'max_rss_mb': report['max_rss'] / 2 ** 20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="measure sbfeed_bot throughput against a fake songbook "
+                    "and a fake telegram bot api"
+    )
+    parser.add_argument("--subscriptions", default='10,1000,50000',
+                        help="comma separated scales to run")
+    parser.add_argument("--subscriptions-per-feed", metavar='N', default=10,
+                        type=int)
+    parser.add_argument("--churn", metavar='N', default=20, type=float,
+                        help="new comments per second over all gigs")
+    parser.add_argument("--duration", metavar='SECONDS', default=30,
+                        type=float)
+    parser.add_argument("--drain", metavar='SECONDS', default=10, type=float,
+                        help="keep running for SECONDS with no new comments "
+                             "to let deliveries catch up")
+    parser.add_argument("--poll-interval", metavar='SECONDS', default=5,
+                        type=int)
+    parser.add_argument("--fetch-concurrency", metavar='N', default=8,
+                        type=int)
+    parser.add_argument("--notify-concurrency", metavar='N', default=8,
+                        type=int)
+    parser.add_argument("--notify-rate", metavar='N', default=1000,
+                        type=float)
+    parser.add_argument("--notify-batch-size", metavar='N', default=500,
+                        type=int)
+    parser.add_argument("--digest-window", metavar='SECONDS', type=int)
+    parser.add_argument("--json", action='store_true',
+                        help="print results as json lines")
+    config = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+
+    receiver, sender = multiprocessing.Pipe(duplex=False)
+    fakes = multiprocessing.get_context('spawn').Process(
+        target=serve_fakes, args=(0, sender), daemon=True
+    )
+    fakes.start()
+    config.url = 'http://127.0.0.1:%d' % (receiver.recv(), )
+
+    with tempfile.TemporaryDirectory() as workdir:
+        config.workdir = workdir
+        if not config.json:
+            print('%8s %6s %9s %9s %8s %8s %8s' % (
+                'subs', 'feeds', 'items/s', 'notif/s', 'p50', 'p99',
+                'rss MiB'))
+        for subscriptions in map(int, config.subscriptions.split(',')):
+            result = run_scale(config, subscriptions)
+            if config.json:
+                print(json.dumps(result), flush=True)
+            else:
+                print('%8d %6d %9.1f %9.1f %7.2fs %7.2fs %8.1f' % (
+                    result['subscriptions'], result['feeds'],
+                    result['items_per_sec'],
+                    result['notifications_per_sec'],
+                    result['p50'], result['p99'], result['rss_mb'],
+                ), flush=True)
+    fakes.terminate()
+
+
+if __name__ == '__main__':
+    main()
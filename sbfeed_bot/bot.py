@@ -1,9 +1,15 @@
 import re
+import time
 import logging
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
+from telegram.error import Unauthorized
 from telegram.ext import CommandHandler, Updater, MessageHandler, Filters
 
 from sbfeed_bot import exceptions
+from sbfeed_bot.webhook import SbFeedWebhook
 
 
 class SbFeedBot:
@@ -14,15 +20,29 @@ class SbFeedBot:
 
 {link}\
 """
+    DIGEST_SEPARATOR = '\n\n\u2014\u2014\u2014\n\n'
+    MAX_MESSAGE_LENGTH = 4096
+    # slugs that turned out not to exist are not fetched again for that long
+    MISSING_FEED_TTL = 60
 
-    def __init__(self, token, model, feeder):
+    def __init__(self, token, model, feeder, probe_concurrency=4,
+                 base_url=None):
         self.logger = logging.getLogger('sbfeed.bot')
         self.model = model
         self.feeder = feeder
         self.token = token
+        # first fetches of unknown feeds, one per slug however many
+        # chats subscribe at once
+        self.probe_executor = ThreadPoolExecutor(
+            max_workers=probe_concurrency, thread_name_prefix='probe'
+        )
+        self.probes = {}
+        self.missing_feeds = {}
+        self.probes_lock = threading.Lock()
         self.slug_re = re.compile(r'^[-a-zA-Z0-9_]{,50}\Z')
-        self.updater = Updater(token=token)
+        self.updater = Updater(token=token, base_url=base_url)
         self.dispatcher = self.updater.dispatcher
+        self.webhook = None
 
         self.dispatcher.add_handler(
             CommandHandler('subscribe', self._handle_subscribe, pass_args=True)
@@ -49,9 +69,20 @@ class SbFeedBot:
         self.logger.info('starting')
         self.updater.start_polling()
 
+    def start_webhook(self, url, listen, port, workers, queue_size):
+        self.logger.info('starting with a webhook')
+        self.webhook = SbFeedWebhook(self.dispatcher, url, listen=listen,
+                                     port=port, workers=workers,
+                                     queue_size=queue_size)
+        self.webhook.start()
+
     def stop(self):
         self.logger.info('stopping')
-        self.updater.stop()
+        if self.webhook is not None:
+            self.webhook.stop()
+        else:
+            self.updater.stop()
+        self.probe_executor.shutdown(wait=False)
 
     def _handle_start(self, bot, update):
         self.logger.info('got /start')
@@ -77,22 +108,102 @@ class SbFeedBot:
         if not self.slug_re.match(slug):
             bot.sendMessage(chat_id=update.message.chat_id, text='broken slug')
             return
-        if not self.model.check_feed_is_known(slug):
-            try:
-                self.feeder.fetch(slug, not_before=None)
-                self.model.init_feed(slug)
-            except exceptions.NotExistError:
-                bot.sendMessage(chat_id=update.message.chat_id,
+        if self.model.check_feed_is_known(slug):
+            self._subscribe(bot, update.message.chat_id, slug)
+            return
+        self._probe_and_subscribe(bot, update.message.chat_id, slug)
+
+    def _probe_and_subscribe(self, bot, chat_id, slug):
+        if self._is_missing(slug):
+            bot.sendMessage(chat_id=chat_id,
+                            text='failed to fetch gig, does it exist?')
+            return
+        bot.sendMessage(chat_id=chat_id,
+                        text='checking %s, hold on' % (slug, ))
+        self._probe(slug).add_done_callback(functools.partial(
+            self._finish_subscribe, bot, chat_id, slug
+        ))
+
+    def _is_missing(self, slug):
+        with self.probes_lock:
+            expires = self.missing_feeds.get(slug)
+            if expires is None:
+                return False
+            if expires > time.monotonic():
+                return True
+            del self.missing_feeds[slug]
+            return False
+
+    def _probe(self, slug):
+        with self.probes_lock:
+            future = self.probes.get(slug)
+            if future is not None:
+                return future
+            future = self.probe_executor.submit(self._init_feed, slug)
+            self.probes[slug] = future
+        # a probe that is done already runs the callback right here,
+        # so it must not be added while holding the lock
+        future.add_done_callback(
+            lambda _: self._forget_probe(slug, future)
+        )
+        return future
+
+    def _forget_probe(self, slug, future):
+        with self.probes_lock:
+            if self.probes.get(slug) is future:
+                del self.probes[slug]
+
+    def _init_feed(self, slug):
+        try:
+            self.feeder.fetch(slug, not_before=None)
+        except exceptions.NotExistError:
+            now = time.monotonic()
+            with self.probes_lock:
+                for missing, expires in list(self.missing_feeds.items()):
+                    if expires <= now:
+                        del self.missing_feeds[missing]
+                self.missing_feeds[slug] = now + self.MISSING_FEED_TTL
+            raise
+        try:
+            self.model.init_feed(slug)
+        except exceptions.AlreadyExistsError:
+            pass
+
+    def _finish_subscribe(self, bot, chat_id, slug, future):
+        # runs in a probe thread, where an exception would go unnoticed
+        try:
+            exc = future.exception()
+            if isinstance(exc, exceptions.NotExistError):
+                bot.sendMessage(chat_id=chat_id,
                                 text='failed to fetch gig, does it exist?')
-                return
-            except Exception as exc:
-                self.logger.exception('failed to fetch gig %r', slug)
-                bot.sendMessage(chat_id=update.message.chat_id,
+            elif exc is not None:
+                self.logger.error('failed to fetch gig %r', slug,
+                                  exc_info=exc)
+                bot.sendMessage(chat_id=chat_id,
                                 text='failed to fetch gig: %s' % (exc, ))
-                return
-        self.model.subscribe(chat_id=update.message.chat_id, feed=slug)
+            else:
+                self._subscribe(bot, chat_id, slug, probe=False)
+        except Exception:
+            self.logger.exception('failed to subscribe %r to %r',
+                                  chat_id, slug)
+
+    def _subscribe(self, bot, chat_id, slug, probe=True):
+        try:
+            self.model.subscribe(chat_id=chat_id, feed=slug)
+        except exceptions.AlreadyExistsError:
+            bot.sendMessage(chat_id=chat_id,
+                            text='you are already subscribed to %s' % (slug, ))
+            return
+        except exceptions.NotExistError:
+            # the janitor collected the feed after it was looked up
+            if probe:
+                self._probe_and_subscribe(bot, chat_id, slug)
+            else:
+                bot.sendMessage(chat_id=chat_id,
+                                text='failed to fetch gig, does it exist?')
+            return
         bot.sendMessage(
-            chat_id=update.message.chat_id,
+            chat_id=chat_id,
             text='congratulations! you subscribed to %s' % (slug, )
         )
 
@@ -143,10 +254,39 @@ class SbFeedBot:
             bot.sendMessage(chat_id=update.message.chat_id,
                             text="you were unsubscribed from everything")
 
-    def notify(self, chat_id, feed,
-               item_title, item_link, item_text, item_pubdate):
+    def render(self, feed, item_title, item_link, item_text, item_pubdate):
         text = self.NOTIFICATION_TMPL.format(
             title=item_title, link=item_link, text=item_text, slug=feed,
         )
+        if len(text) > self.MAX_MESSAGE_LENGTH:
+            text = text[:self.MAX_MESSAGE_LENGTH - 1] + '\u2026'
+        return text
+
+    def pack_digest(self, texts):
+        # packs rendered items into as few messages as telegram accepts,
+        # returns (text, number of items) per message
+        messages = []
+        for text in texts:
+            if messages and len(messages[-1][0]) + len(self.DIGEST_SEPARATOR) \
+                    + len(text) <= self.MAX_MESSAGE_LENGTH:
+                messages[-1] = (messages[-1][0] + self.DIGEST_SEPARATOR + text,
+                                messages[-1][1] + 1)
+            else:
+                messages.append((text, 1))
+        return messages
+
+    def join_digest(self, texts):
+        return self.DIGEST_SEPARATOR.join(texts)
+
+    def send_text(self, chat_id, text):
         self.dispatcher.bot.send_message(chat_id=chat_id, text=text,
                                          disable_web_page_preview=True)
+
+    def token_is_valid(self):
+        # telegram answers 401 and 403 with the same Unauthorized error,
+        # so a chat that blocked the bot looks like a revoked token
+        try:
+            self.dispatcher.bot.get_me()
+        except Unauthorized:
+            return False
+        return True
@@ -0,0 +1,100 @@
+import time
+import logging
+import threading
+import contextlib
+import collections
+from urllib.parse import urlsplit
+from http.client import HTTPConnection, HTTPSConnection, HTTPException
+
+
+class HttpConnectionPool:
+    CONNECTION_CLASSES = {'http': HTTPConnection, 'https': HTTPSConnection}
+
+    def __init__(self, *, size, idle_timeout, timeout=None):
+        self.size = size
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.logger = logging.getLogger('sbfeed.connpool')
+        self.idle = collections.defaultdict(list)
+        self.lock = threading.Lock()
+        self.counters = collections.Counter()
+
+    def stats(self):
+        with self.lock:
+            stats = dict(self.counters)
+            stats['idle'] = sum(len(idle) for idle in self.idle.values())
+        return stats
+
+    def _connect(self, key):
+        scheme, netloc = key
+        with self.lock:
+            self.counters['connections'] += 1
+        return self.CONNECTION_CLASSES[scheme](netloc, timeout=self.timeout)
+
+    def _acquire(self, key):
+        now = time.monotonic()
+        with self.lock:
+            idle = self.idle[key]
+            while idle:
+                conn, released = idle.pop()
+                if now - released < self.idle_timeout:
+                    self.counters['reused'] += 1
+                    return conn, True
+                self.counters['expired'] += 1
+                conn.close()
+        return self._connect(key), False
+
+    def _release(self, key, conn):
+        with self.lock:
+            idle = self.idle[key]
+            if len(idle) < self.size:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def _send(self, key, method, path, headers):
+        conn, reused = self._acquire(key)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except (HTTPException, OSError):
+            conn.close()
+            if not reused:
+                raise
+        # keep-alive connection was dropped by the server while idle
+        self.logger.debug('stale connection to %s, reconnecting', key[1])
+        with self.lock:
+            self.counters['stale'] += 1
+        conn = self._connect(key)
+        try:
+            conn.request(method, path, headers=headers)
+            return conn, conn.getresponse()
+        except Exception:
+            conn.close()
+            raise
+
+    @contextlib.contextmanager
+    def request(self, method, url, headers):
+        parts = urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        with self.lock:
+            self.counters['requests'] += 1
+        conn, response = self._send(key, method, path, headers)
+        try:
+            yield response
+        finally:
+            # a connection can only be reused once the response was consumed
+            if response.isclosed() and not response.will_close:
+                self._release(key, conn)
+            else:
+                conn.close()
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle.values():
+                for conn, released in idle:
+                    conn.close()
+            self.idle.clear()
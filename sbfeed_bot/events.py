@@ -0,0 +1,36 @@
+import threading
+
+
+class Signal:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending = False
+        self.callbacks = []
+
+    def subscribe(self, callback):
+        # callback is called from the notifying thread
+        self.callbacks.append(callback)
+
+    def notify(self):
+        with self.condition:
+            self.pending = True
+            self.condition.notify_all()
+        for callback in self.callbacks:
+            callback()
+
+    def wait(self, timeout=None):
+        # returns True if the signal fired since the last wait();
+        # several notify() calls in between wake a waiter only once
+        with self.condition:
+            if not self.pending:
+                self.condition.wait(timeout)
+            fired, self.pending = self.pending, False
+            return fired
+
+
+class SbFeedEvents:
+    def __init__(self):
+        # new feed items were committed
+        self.items_stored = Signal()
+        # a feed was added or its next fetch time changed
+        self.feeds_changed = Signal()
@@ -1,54 +1,149 @@
+import re
 import time
 import logging
 import calendar
+import collections
+from email.utils import parsedate_to_datetime
 from urllib.parse import quote as urlencode
 from urllib.error import HTTPError
-from urllib.request import Request, urlopen
-from xml.etree.cElementTree import parse as etree_parse
+from xml.etree.ElementTree import iterparse as etree_iterparse
 
-from sbfeed_bot import exceptions
+from sbfeed_bot import exceptions, metrics
+from sbfeed_bot.connpool import HttpConnectionPool
+
+
+FeedFetchResult = collections.namedtuple(
+    'FeedFetchResult', 'last_modified items etag expires'
+)
+
+
+class CountingReader:
+    def __init__(self, response):
+        self.response = response
+        self.bytes_read = 0
+
+    def read(self, size=None):
+        # HTTPResponse.read(-1) reads the socket until it is closed, which
+        # blocks on a keep-alive connection; None stops at Content-Length
+        data = self.response.read(size)
+        self.bytes_read += len(data)
+        return data
 
 
 class SbFeedFeeder:
     DATETIME_FMT = "%a, %d %b %Y %H:%M:%S %z"
+    # never trust upstream caching hints for longer than that
+    MAX_CACHE_AGE = 3600
+    # read the rest of a response after an early stop if it is that small,
+    # so the connection can go back to the pool
+    DRAIN_LIMIT = 64 * 1024
 
-    def __init__(self, songbook_url):
+    def __init__(self, songbook_url, timeout=None,
+                 pool_size=4, idle_timeout=60):
         self.url_tmpl = songbook_url + '/comments/feeds/%s'
+        self.pool = HttpConnectionPool(size=pool_size,
+                                       idle_timeout=idle_timeout,
+                                       timeout=timeout)
         self.logger = logging.getLogger('sbfeed.feeder')
+        self.max_age_re = re.compile(r'\bmax-age\s*=\s*(\d+)')
 
     def _atom_date(self, string):
         return int(calendar.timegm(time.strptime(string, self.DATETIME_FMT)))
 
-    def fetch(self, feed, not_before):
-        url = self.url_tmpl % (urlencode(feed), )
-        request = Request(url)
+    def _expires(self, headers):
+        now = time.time()
+        cache_control = headers.get('Cache-Control', '').lower()
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            return None
+        match = self.max_age_re.search(cache_control)
+        if match:
+            age = int(match.group(1)) - int(headers.get('Age') or 0)
+        elif headers.get('Expires'):
+            try:
+                age = parsedate_to_datetime(headers['Expires']).timestamp()
+            except (TypeError, ValueError):
+                return None
+            age -= now
+        else:
+            return None
+        if age <= 0:
+            return None
+        return int(now + min(age, self.MAX_CACHE_AGE))
+
+    def _parse_item(self, item):
+        itemd = {'pubdate': self._atom_date(item.find('pubDate').text)}
+        itemd['title'] = item.find('title').text
+        itemd['link'] = item.find('link').text
+        text = item.find('description').text
+        if text.startswith('<pre>') and text.endswith('</pre>'):
+            text = text[len('<pre>'):-len('</pre>')]
+        itemd['text'] = text.strip()
+        return itemd
+
+    def iter_feed(self, response):
+        channel = None
+        for event, elem in etree_iterparse(response, events=('start', 'end')):
+            if event == 'start':
+                if elem.tag == 'channel':
+                    channel = elem
+                continue
+            if elem.tag == 'lastBuildDate' and channel is not None:
+                yield 'lastBuildDate', self._atom_date(elem.text)
+            elif elem.tag == 'item':
+                yield 'item', self._parse_item(elem)
+                # forget processed items to keep memory usage flat
+                if channel is not None:
+                    channel.remove(elem)
+                elem.clear()
+
+    def feed_url(self, feed):
+        return self.url_tmpl % (urlencode(feed), )
+
+    def fetch(self, feed, not_before, etag=None):
+        url = self.feed_url(feed)
+        headers = {'User-Agent': 'sbfeed_bot'}
         if not_before:
-            request.add_header('If-Modified-Since',
-                               time.strftime("%a, %d %b %Y %H:%M:%S GMT",
-                                             time.gmtime(not_before)))
-        self.logger.info('fetching %r (%r)', url, request.headers)
-        try:
-            response = urlopen(request)
-        except HTTPError as exc:
-            if exc.code == 304:
+            headers['If-Modified-Since'] = time.strftime(
+                "%a, %d %b %Y %H:%M:%S GMT", time.gmtime(not_before)
+            )
+        if etag:
+            headers['If-None-Match'] = etag
+        self.logger.info('fetching %r (%r)', url, headers)
+        started = time.perf_counter()
+        with self.pool.request('GET', url, headers) as response:
+            headers_received = time.perf_counter()
+            metrics.FETCH_SECONDS.observe(headers_received - started)
+            metrics.FETCH_RESPONSES.inc(response.status)
+            if response.status != 200:
+                metrics.FETCH_BYTES.inc(amount=len(response.read()))
+            etag = response.headers.get('ETag', etag)
+            expires = self._expires(response.headers)
+            if response.status == 304:
                 # not modified
-                return not_before, []
-            elif exc.code == 404:
+                return FeedFetchResult(not_before, [], etag, expires)
+            elif response.status == 404:
                 raise exceptions.NotExistError()
-            raise
-        tree = etree_parse(response)
-        build_date = self._atom_date(tree.find('./channel/lastBuildDate').text)
-        result = []
-        for item in tree.findall('./channel/item')[::-1]:
-            pubdate = self._atom_date(item.find('pubDate').text)
-            if not_before and pubdate <= not_before:
-                continue
-            itemd = {'pubdate': pubdate}
-            itemd['title'] = item.find('title').text
-            itemd['link'] = item.find('link').text
-            text = item.find('description').text
-            if text.startswith('<pre>') and text.endswith('</pre>'):
-                text = text[len('<pre>'):-len('</pre>')]
-            itemd['text'] = text.strip()
-            result.append(itemd)
-        return build_date, result
+            elif response.status != 200:
+                raise HTTPError(url, response.status, response.reason,
+                                response.headers, None)
+            build_date = None
+            result = []
+            body = CountingReader(response)
+            for kind, value in self.iter_feed(body):
+                if kind == 'lastBuildDate':
+                    build_date = value
+                elif not_before and value['pubdate'] <= not_before:
+                    # items go newest first, the rest was seen already
+                    if build_date is not None:
+                        break
+                else:
+                    result.append(value)
+            if (not response.isclosed() and response.length is not None
+                    and response.length <= self.DRAIN_LIMIT):
+                body.read()
+            metrics.FETCH_BYTES.inc(amount=body.bytes_read)
+            metrics.FETCH_PARSE_SECONDS.observe(time.perf_counter()
+                                                - headers_received)
+        if build_date is None:
+            raise ValueError('feed %r has no lastBuildDate' % (feed, ))
+        return FeedFetchResult(build_date, result[::-1], etag, expires)
@@ -0,0 +1,104 @@
+import time
+import logging
+import threading
+import collections
+from urllib.parse import urlsplit
+from concurrent.futures import ThreadPoolExecutor
+
+from sbfeed_bot import metrics
+
+
+class SbFeedFetcher:
+    def __init__(self, feeder, model, *, concurrency, per_host, lease=None):
+        self.feeder = feeder
+        self.model = model
+        self.lease = lease
+        self.logger = logging.getLogger('sbfeed.fetcher')
+        self.executor = ThreadPoolExecutor(max_workers=concurrency,
+                                           thread_name_prefix='fetcher')
+        self.per_host = per_host
+        self.host_limits = collections.defaultdict(
+            lambda: threading.BoundedSemaphore(self.per_host)
+        )
+        self.in_flight = set()
+        self.lock = threading.Lock()
+
+    def host(self, slug):
+        return urlsplit(self.feeder.feed_url(slug)).netloc
+
+    def _host_limit(self, slug):
+        host = self.host(slug)
+        with self.lock:
+            return self.host_limits[host]
+
+    def shards(self):
+        return self.lease.shards('fetch') if self.lease else None
+
+    def next_fetch_time(self, in_flight=None):
+        # feeds in flight signal feeds_changed once done, so they are left
+        # out instead of waking the scheduler while they are still due
+        if in_flight is None:
+            with self.lock:
+                in_flight = set(self.in_flight)
+        return self.model.get_next_fetch_time(shards=self.shards(),
+                                              exclude=in_flight)
+
+    def schedule(self):
+        submitted = 0
+        for row in self.model.get_fetches_needed(shards=self.shards()):
+            slug = row[0]
+            with self.lock:
+                if slug in self.in_flight:
+                    continue
+                self.in_flight.add(slug)
+            self.executor.submit(self._process, *row)
+            submitted += 1
+        return submitted
+
+    def _process(self, slug, last_fetched, last_tried, etag):
+        try:
+            with self._host_limit(slug):
+                self.process_feed(slug, last_fetched, last_tried, etag)
+        except Exception:
+            self.logger.exception('failed to process feed %r', slug)
+        finally:
+            with self.lock:
+                self.in_flight.discard(slug)
+            # the feed counts for the next fetch time again
+            if self.model.events:
+                self.model.events.feeds_changed.notify()
+
+    def process_feed(self, slug, last_fetched, last_tried, etag):
+        now = time.time()
+        self.logger.info('need to fetch %r: last fetched %ds ago '
+                         'and last tried %ds ago',
+                         slug, now - (last_fetched or now + 1),
+                         now - (last_tried or now + 1))
+        try:
+            result = self.feeder.fetch(slug, last_fetched, etag=etag)
+        except Exception:
+            self.logger.exception('failed to fetch %r', slug)
+            metrics.FETCH_ERRORS.inc()
+            self.model.mark_feed_as_processed(slug, last_modified=None)
+            return
+
+        for item in result.items:
+            self.logger.info('feed %r: new item %r, see %r',
+                             slug, item['title'], item['link'])
+        if result.items:
+            try:
+                self.model.store_items(slug, result.items)
+            except Exception:
+                self.logger.exception('failed to store %d items of %r',
+                                      len(result.items), slug)
+                metrics.FETCH_ERRORS.inc()
+                self.model.mark_feed_as_processed(slug, last_modified=None)
+                return
+        self.model.mark_feed_as_processed(slug,
+                                          last_modified=result.last_modified,
+                                          etag=result.etag,
+                                          expires=result.expires,
+                                          changed=bool(result.items))
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -1,12 +1,21 @@
 import argparse
+import functools
 import logging
+import multiprocessing
 import time
 import threading
 import sys
 
-from sbfeed_bot.model import SbFeedModel
+from sbfeed_bot.model import SbFeedModel, STORAGE_PROFILES
 from sbfeed_bot.feed import SbFeedFeeder
+from sbfeed_bot.fetcher import SbFeedFetcher
+from sbfeed_bot.notifier import SbFeedNotifier
+from sbfeed_bot.schedule import SbFeedSchedule
+from sbfeed_bot.events import SbFeedEvents
+from sbfeed_bot.aio import SbFeedAsyncRuntime
+from sbfeed_bot.sharding import SbFeedShardLease
 from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot import metrics
 
 
 def setup_logging(logfile, level):
@@ -18,54 +27,172 @@ def setup_logging(logfile, level):
     logging.captureWarnings(capture=True)
 
 
-def peridodic_fetcher(feeder, model):
+def peridodic_fetcher(fetcher, events, stats_every=60,
+                      min_wait=1, idle_wait=300):
     logger = logging.getLogger('sbfeed.fetcher')
+    stats_reported = time.monotonic()
     while True:
-        for slug, last_fetched, last_tried in model.get_fetches_needed():
-            now = time.time()
-            logger.info('need to fetch %r: last fetched %ds ago '
-                        'and last tried %ds ago',
-                        slug, now - (last_fetched or now + 1),
-                        now - (last_tried or now + 1))
-            try:
-                last_modified, items = feeder.fetch(slug, last_fetched)
-            except Exception:
-                logger.exception('failed to fetch')
-                model.mark_feed_as_processed(slug, last_modified=None)
-                time.sleep(10)
-                continue
-
-            for item in items:
-                logger.info('feed %r: new item %r, see %r',
-                            slug, item['title'], item['link'])
-                try:
-                    model.store_item(slug, item['title'], item['link'],
-                                     item['text'], item['pubdate'])
-                except Exception:
-                    logger.exception('failed to store item %r', item)
-            model.mark_feed_as_processed(slug, last_modified=last_modified)
-
-        time.sleep(10)
-
-
-def periodic_notifier(model, bot):
-    logger = logging.getLogger('sbfeed.notifier')
+        fetcher.schedule()
+        if time.monotonic() - stats_reported > stats_every:
+            logger.info('http connection pool: %r',
+                        fetcher.feeder.pool.stats())
+            stats_reported = time.monotonic()
+        # sleep until the next feed not in flight is due, or a feed was
+        # added or processed
+        next_fetch = fetcher.next_fetch_time()
+        if next_fetch is None:
+            timeout = idle_wait
+        else:
+            timeout = min(max(next_fetch - time.time(), min_wait), idle_wait)
+        events.feeds_changed.wait(timeout)
+
+
+def periodic_notifier(notifier, events, idle_wait=300):
     while True:
-        for item in model.check_notifications_needed():
-            logger.info('need to notify %d about feed %r item %r, see %r',
-                        item['chat_id'], item['feed'], item['item_title'],
-                        item['item_link'])
-            try:
-                bot.notify(item['chat_id'], item['feed'], item['item_title'],
-                           item['item_link'], item['item_text'],
-                           item['item_pub_date'])
-                logger.info('notified successfully')
-            except Exception:
-                logger.exception('failed to notify')
-            finally:
-                model.mark_notification_as_sent(item['chat_id'], item['feed'],
-                                                item['item_pub_date'])
-        time.sleep(10)
+        if not notifier.run_once():
+            events.items_stored.wait(notifier.wait_time(idle_wait))
+
+
+def cleanup_database(model, min_age):
+    logger = logging.getLogger('sbfeed.janitor')
+    try:
+        items = model.prune_items(min_age)
+        messages = model.prune_outbox(min_age)
+        feeds = model.collect_orphan_feeds(min_age)
+        free_pages = model.vacuum()
+    except Exception:
+        logger.exception('failed to clean up database')
+        return
+    logger.info('removed %d delivered items, %d finished outbox messages '
+                'and %d orphaned feeds, %d pages left free',
+                items, messages, feeds, free_pages)
+
+
+def periodic_janitor(model, interval, min_age):
+    while True:
+        time.sleep(interval)
+        cleanup_database(model, min_age)
+
+
+def create_model(args, events):
+    profile = STORAGE_PROFILES[args.storage_profile]
+    if args.db_max_connections:
+        profile = profile._replace(max_connections=args.db_max_connections)
+    schedule = SbFeedSchedule(min_interval=args.poll_min_interval,
+                              max_interval=args.poll_max_interval)
+    if args.postgres:
+        from sbfeed_bot.pgmodel import SbFeedPgModel
+        return SbFeedPgModel(args.postgres,
+                             max_connections=profile.max_connections,
+                             schedule=schedule, events=events)
+    return SbFeedModel(args.database, profile=profile,
+                       schedule=schedule, events=events)
+
+
+def create_feeder(args):
+    return SbFeedFeeder(args.songbook_url, timeout=args.fetch_timeout,
+                        pool_size=args.http_pool_size,
+                        idle_timeout=args.http_idle_timeout)
+
+
+def start_threads(workers):
+    logger = logging.getLogger('sbfeed.main')
+    for worker in workers:
+        logger.info('spawning %r', (worker, ))
+        worker.daemon = True
+        worker.start()
+
+
+def check_threads(workers):
+    logger = logging.getLogger('sbfeed.main')
+    for worker in workers:
+        if not worker.is_alive():
+            logger.critical('%r died, exiting', (worker, ))
+            sys.exit(1)
+
+
+def periodic_lease_renewal(lease):
+    logger = logging.getLogger('sbfeed.sharding')
+    while True:
+        try:
+            lease.renew()
+        except Exception:
+            logger.exception('failed to renew shard leases')
+        time.sleep(lease.ttl / 3)
+
+
+def start_webhook(bot, args):
+    host, _, port = args.webhook_listen.rpartition(':')
+    bot.start_webhook(args.webhook_url, listen=host or '127.0.0.1',
+                      port=int(port), workers=args.webhook_workers,
+                      queue_size=args.webhook_queue_size)
+
+
+def spawn_worker(args, index):
+    # spawned process gets a fresh interpreter, so pass it only
+    # what can be pickled
+    config = argparse.Namespace(**vars(args))
+    config.logfile = (None if args.logfile is sys.stderr
+                      else args.logfile.name)
+    process = multiprocessing.get_context('spawn').Process(
+        name='worker-%d' % (index, ), target=run_worker,
+        args=(config, index), daemon=True,
+    )
+    logging.getLogger('sbfeed.main').info('spawning %r', process)
+    process.start()
+    return process
+
+
+def run_worker(config, index):
+    setup_logging(open(config.logfile, 'a') if config.logfile else sys.stderr,
+                  level=logging.INFO)
+    events = SbFeedEvents()
+    model = create_model(config, events)
+    lease = SbFeedShardLease(model, index=index, total=config.shards,
+                             ttl=config.lease_ttl)
+    lease.renew()
+    if config.metrics_port:
+        metrics.start_server(config.metrics_port + 1 + index)
+    feeder = create_feeder(config)
+    fetcher = SbFeedFetcher(feeder, model,
+                            concurrency=config.fetch_concurrency,
+                            per_host=config.fetch_per_host, lease=lease)
+    bot = SbFeedBot(config.token, model, feeder,
+                    base_url=config.telegram_api_url)
+    notifier = SbFeedNotifier(model, bot,
+                              concurrency=config.notify_concurrency,
+                              rate=config.notify_rate / config.workers,
+                              batch_size=config.notify_batch_size,
+                              digest_window=config.digest_window,
+                              render_cache_size=config.render_cache_size,
+                              lease=lease)
+    # feeds and items added by other processes do not fire local events
+    idle_wait = config.worker_poll_interval
+    workers = [
+        threading.Thread(
+            name='lease', target=periodic_lease_renewal, args=(lease, )
+        ),
+        threading.Thread(
+            name='fetcher', target=peridodic_fetcher,
+            args=(fetcher, events), kwargs={'idle_wait': idle_wait}
+        ),
+        threading.Thread(
+            name='notifier', target=periodic_notifier,
+            args=(notifier, events), kwargs={'idle_wait': idle_wait}
+        ),
+    ]
+    start_threads(workers)
+    try:
+        while True:
+            time.sleep(1)
+            check_threads(workers)
+    except KeyboardInterrupt:
+        return
+    finally:
+        lease.release()
+        fetcher.shutdown()
+        notifier.shutdown()
+        model.close()
 
 
 def main():
@@ -75,53 +202,217 @@ def main():
                         help="write logs to FILE")
     parser.add_argument("-t", "--telegram-token", dest='token',
                         required=True, help="telegram bot api token")
-    parser.add_argument("-d", "--database", metavar='FILE', required=True,
+    parser.add_argument("--telegram-api-url", metavar='URL',
+                        help="bot api url the token is appended to, "
+                             "e.g. of a local bot api server")
+    parser.add_argument("-d", "--database", metavar='FILE',
                         type=argparse.FileType('a'),
                         help="sqlite3 database file")
+    parser.add_argument("--postgres", metavar='DSN',
+                        help="store data in postgresql instead of sqlite3, "
+                             "requires psycopg2")
+    parser.add_argument("--storage-profile", default='wal',
+                        choices=sorted(STORAGE_PROFILES),
+                        help="sqlite3 journal and cache settings")
+    parser.add_argument("--db-max-connections", metavar='N', type=int,
+                        help="keep no more than N database connections open")
     parser.add_argument("-s", "--songbook-url",
                         default='https://songbook.angri.ru',
                         help='songbook url, with no trailing slash')
+    parser.add_argument("--fetch-concurrency", metavar='N', default=8,
+                        type=int, help="fetch up to N feeds in parallel")
+    parser.add_argument("--fetch-per-host", metavar='N', default=4,
+                        type=int, help="open no more than N concurrent "
+                                       "requests to a single host")
+    parser.add_argument("--fetch-timeout", metavar='SECONDS', default=30,
+                        type=float, help="network timeout for a single feed")
+    parser.add_argument("--poll-min-interval", metavar='SECONDS', default=10,
+                        type=int, help="never poll a feed more often")
+    parser.add_argument("--poll-max-interval", metavar='SECONDS',
+                        default=3600, type=int,
+                        help="poll even quiet feeds at least that often")
+    parser.add_argument("--http-pool-size", metavar='N', default=4,
+                        type=int, help="keep up to N idle keep-alive "
+                                       "connections per host")
+    parser.add_argument("--http-idle-timeout", metavar='SECONDS', default=60,
+                        type=float, help="close keep-alive connections "
+                                         "idle for longer than SECONDS")
+    parser.add_argument("--notify-concurrency", metavar='N', default=8,
+                        type=int, help="deliver to up to N chats in parallel")
+    parser.add_argument("--notify-rate", metavar='N', default=25,
+                        type=float, help="send no more than N telegram "
+                                         "messages per second")
+    parser.add_argument("--notify-batch-size", metavar='N', default=500,
+                        type=int, help="pick up to N pending notifications "
+                                       "at once")
+    parser.add_argument("--digest-window", metavar='SECONDS', type=int,
+                        help="collect items of a gig for up to SECONDS and "
+                             "send them to a chat in as few messages as "
+                             "possible")
+    parser.add_argument("--render-cache-size", metavar='N', default=1024,
+                        type=int, help="keep up to N rendered notifications "
+                                       "for fan-out to many chats")
+    parser.add_argument("--retention-interval", metavar='SECONDS',
+                        default=3600, type=float,
+                        help="clean up the database every SECONDS")
+    parser.add_argument("--retention-min-age", metavar='SECONDS',
+                        default=86400, type=int,
+                        help="keep delivered items and unused feeds "
+                             "for at least SECONDS")
+    parser.add_argument("--asyncio", action='store_true',
+                        help="run everything on a single asyncio event loop "
+                             "instead of worker threads")
+    parser.add_argument("--async-workers", metavar='N', default=8, type=int,
+                        help="run blocking calls of the asyncio mode "
+                             "in N threads")
+    parser.add_argument("--workers", metavar='N', default=0, type=int,
+                        help="fetch and deliver in N worker processes")
+    parser.add_argument("--shards", metavar='N', default=16, type=int,
+                        help="split feeds and chats into N shards "
+                             "between workers")
+    parser.add_argument("--lease-ttl", metavar='SECONDS', default=30,
+                        type=int, help="take over shards of a worker "
+                                       "silent for SECONDS")
+    parser.add_argument("--worker-poll-interval", metavar='SECONDS',
+                        default=2, type=float,
+                        help="check for new feeds and items made by other "
+                             "processes every SECONDS")
+    parser.add_argument("--webhook-url", metavar='URL',
+                        help="receive updates pushed by telegram to URL "
+                             "instead of polling for them; its path should "
+                             "be secret")
+    parser.add_argument("--webhook-listen", metavar='HOST:PORT',
+                        default='127.0.0.1:8443',
+                        help="serve the webhook on HOST:PORT, behind a "
+                             "reverse proxy that handles tls")
+    parser.add_argument("--webhook-workers", metavar='N', default=4,
+                        type=int, help="process up to N updates in parallel")
+    parser.add_argument("--webhook-queue-size", metavar='N', default=256,
+                        type=int, help="queue up to N updates, telegram "
+                                       "retries the ones that do not fit")
+    parser.add_argument("--metrics-port", metavar='PORT', type=int,
+                        help="serve prometheus metrics on "
+                             "http://127.0.0.1:PORT/metrics, worker N "
+                             "uses PORT+1+N")
     parser.add_argument('--create-db', action='store_true',
                         help='only initialize database structure and exit')
+    parser.add_argument('--rebuild-db', action='store_true',
+                        help='only upgrade the sqlite3 database and rebuild '
+                             'it with incremental vacuum, then exit; locks '
+                             'the database and needs as much free disk '
+                             'space as it takes')
     args = parser.parse_args()
 
+    if args.workers and args.asyncio:
+        parser.error('--workers and --asyncio can not be used together')
+    if (args.database is None) == (args.postgres is None):
+        parser.error('exactly one of --database and --postgres is required')
+    if args.rebuild_db and args.postgres is not None:
+        parser.error('--rebuild-db only applies to --database')
+
     setup_logging(args.logfile, level=logging.INFO)
 
-    args.database.close()
-    model = SbFeedModel(args.database.name)
+    if args.database is not None:
+        args.database.close()
+        args.database = args.database.name
+    events = SbFeedEvents()
+    model = create_model(args, events)
     if args.create_db:
         model.create_db()
         sys.exit(0)
+    model.upgrade_db()
+    if args.rebuild_db:
+        model.rebuild_db()
+        sys.exit(0)
+    if args.metrics_port:
+        metrics.NOTIFY_BACKLOG.set_function(model.count_due_subscriptions)
+        metrics.start_server(args.metrics_port)
 
-    feeder = SbFeedFeeder(args.songbook_url)
-    bot = SbFeedBot(args.token, model, feeder)
+    feeder = create_feeder(args)
+    fetcher = SbFeedFetcher(feeder, model,
+                            concurrency=args.fetch_concurrency,
+                            per_host=args.fetch_per_host)
+    bot = SbFeedBot(args.token, model, feeder,
+                    base_url=args.telegram_api_url)
+    notifier = SbFeedNotifier(model, bot,
+                              concurrency=args.notify_concurrency,
+                              rate=args.notify_rate,
+                              batch_size=args.notify_batch_size,
+                              digest_window=args.digest_window,
+                              render_cache_size=args.render_cache_size)
 
     logger = logging.getLogger('sbfeed.main')
+    if args.asyncio:
+        runtime = SbFeedAsyncRuntime(
+            fetcher, notifier, bot, events, workers=args.async_workers,
+            cleanup=functools.partial(cleanup_database, model,
+                                      args.retention_min_age),
+            cleanup_interval=args.retention_interval,
+            poll_updates=args.webhook_url is None,
+        )
+        if args.webhook_url:
+            start_webhook(bot, args)
+        logger.info('starting asyncio runtime')
+        try:
+            runtime.run()
+        except KeyboardInterrupt:
+            return
+        except Exception:
+            logger.critical('asyncio runtime died, exiting', exc_info=True)
+            sys.exit(1)
+        finally:
+            if args.webhook_url:
+                bot.stop()
+            model.close()
+        return
+
     workers = [
         threading.Thread(
-            name='fetcher', target=peridodic_fetcher, args=(feeder, model)
-        ),
-        threading.Thread(
-            name='notifier', target=periodic_notifier, args=(model, bot)
+            name='janitor', target=periodic_janitor,
+            args=(model, args.retention_interval, args.retention_min_age)
         ),
     ]
-    for worker in workers:
-        logger.info('spawning %r', (worker, ))
-        worker.daemon = True
-        worker.start()
-    logger.info('starting bot updater')
-    bot.start()
+    processes = []
+    if args.workers:
+        # fetching and delivery happen in worker processes,
+        # this one only serves bot commands
+        processes = [spawn_worker(args, index)
+                     for index in range(args.workers)]
+    else:
+        workers += [
+            threading.Thread(
+                name='fetcher', target=peridodic_fetcher,
+                args=(fetcher, events)
+            ),
+            threading.Thread(
+                name='notifier', target=periodic_notifier,
+                args=(notifier, events)
+            ),
+        ]
+    start_threads(workers)
+    if args.webhook_url:
+        start_webhook(bot, args)
+    else:
+        logger.info('starting bot updater')
+        bot.start()
     try:
         while True:
             time.sleep(1)
-            for worker in workers:
-                if not worker.is_alive():
-                    logger.critical('%r died, exiting', (worker, ))
-                    sys.exit(1)
+            check_threads(workers)
+            for index, process in enumerate(processes):
+                if not process.is_alive():
+                    logger.error('%r died with exit code %r, restarting',
+                                 process, process.exitcode)
+                    processes[index] = spawn_worker(args, index)
     except KeyboardInterrupt:
         return
     finally:
         bot.stop()
+        for process in processes:
+            process.terminate()
+        fetcher.shutdown()
+        notifier.shutdown()
+        model.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,233 @@
+import time
+import bisect
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30)
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.lock = threading.Lock()
+
+    def _label_str(self, values, extra=()):
+        pairs = list(zip(self.label_names, values)) + list(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join(
+            '%s="%s"' % (name, str(value).replace('\\', r'\\')
+                         .replace('"', r'\"').replace('\n', r'\n'))
+            for name, value in pairs
+        )
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        lines.extend(self._samples())
+        return lines
+
+
+class Counter(Metric):
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+
+    def inc(self, *labels, amount=1):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def _samples(self):
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %r' % (self.name, self._label_str(labels), value)
+                for labels, value in values]
+
+
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=()):
+        super().__init__(name, help, labels)
+        self.values = {}
+        self.callback = None
+
+    def set(self, value, *labels):
+        with self.lock:
+            self.values[labels] = value
+
+    def set_function(self, callback):
+        # evaluated on every scrape
+        self.callback = callback
+
+    def _samples(self):
+        if self.callback is not None:
+            try:
+                self.set(self.callback())
+            except Exception:
+                logging.getLogger('sbfeed.metrics').exception(
+                    'failed to compute %s', self.name
+                )
+        with self.lock:
+            values = sorted(self.values.items())
+        return ['%s%s %r' % (self.name, self._label_str(labels), value)
+                for labels, value in values]
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'started')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.started,
+                               *self.labels)
+
+
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        # labels -> [counts per bucket and +Inf, sum]
+        self.values = {}
+
+    def observe(self, value, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [
+                    [0] * (len(self.buckets) + 1), 0
+                ]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def time(self, *labels):
+        return _Timer(self, labels)
+
+    def _samples(self):
+        with self.lock:
+            values = sorted((labels, list(counts), total)
+                            for labels, (counts, total)
+                            in self.values.items())
+        lines = []
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf', ), counts):
+                cumulative += count
+                lines.append('%s_bucket%s %d' % (
+                    self.name, self._label_str(labels, [('le', bound)]),
+                    cumulative
+                ))
+            lines.append('%s_sum%s %r' % (self.name, self._label_str(labels),
+                                          total))
+            lines.append('%s_count%s %d' % (self.name,
+                                            self._label_str(labels),
+                                            cumulative))
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+FETCH_SECONDS = REGISTRY.register(Histogram(
+    'sbfeed_fetch_seconds',
+    'Time from sending a feed request to getting response headers.'
+))
+FETCH_PARSE_SECONDS = REGISTRY.register(Histogram(
+    'sbfeed_fetch_parse_seconds',
+    'Time spent reading and parsing a feed body.'
+))
+FETCH_RESPONSES = REGISTRY.register(Counter(
+    'sbfeed_fetch_responses_total',
+    'Feed responses by HTTP status.', labels=['status']
+))
+FETCH_BYTES = REGISTRY.register(Counter(
+    'sbfeed_fetch_bytes_total', 'Feed body bytes read.'
+))
+FETCH_ERRORS = REGISTRY.register(Counter(
+    'sbfeed_fetch_errors_total', 'Feeds that failed to be fetched or stored.'
+))
+TRANSACTION_SECONDS = REGISTRY.register(Histogram(
+    'sbfeed_transaction_seconds',
+    'Database transaction duration by model method.', labels=['method']
+))
+NOTIFY_BACKLOG = REGISTRY.register(Gauge(
+    'sbfeed_notify_backlog',
+    'Subscriptions with undelivered items.'
+))
+NOTIFY_BATCH = REGISTRY.register(Gauge(
+    'sbfeed_notify_batch_size',
+    'Notifications in the last batch picked by the notifier.'
+))
+SEND_SECONDS = REGISTRY.register(Histogram(
+    'sbfeed_send_seconds', 'Telegram send_message call duration.'
+))
+SEND_RESULTS = REGISTRY.register(Counter(
+    'sbfeed_send_total', 'Telegram messages by outcome.', labels=['result']
+))
+UPDATES = REGISTRY.register(Counter(
+    'sbfeed_webhook_updates_total',
+    'Updates posted to the webhook by outcome.', labels=['result']
+))
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = self.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logging.getLogger('sbfeed.metrics').debug(format, *args)
+
+
+def start_server(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(name='metrics', target=server.serve_forever,
+                              daemon=True)
+    thread.start()
+    logging.getLogger('sbfeed.metrics').info(
+        'serving metrics on http://%s:%d/metrics', host, port
+    )
+    return server
@@ -0,0 +1,79 @@
+import sys
+import logging
+import argparse
+
+from sbfeed_bot.model import SbFeedModel
+
+
+# tables and columns to copy, in foreign key order
+TABLES = [
+    ('feed', ['slug', 'last_modified', 'last_tried_to_fetch', 'etag',
+              'expires', 'last_pubdate', 'created', 'next_fetch',
+              'fetch_interval', 'fetch_errors', 'shard_key']),
+    ('feed_item', ['feed', 'title', 'link', 'text', 'pubdate']),
+    ('subscription', ['chat_id', 'feed', 'last_notified']),
+    ('outbox', ['id', 'key', 'chat_id', 'feed', 'first_pubdate', 'items',
+                'state', 'attempts', 'next_attempt', 'claimed_by',
+                'claimed_until', 'last_error', 'created']),
+]
+
+
+def migrate(source, target, batch_size=1000):
+    logger = logging.getLogger('sbfeed.migrate')
+    source.upgrade_db()
+    target.create_db()
+    with source._connection() as src, target._connection() as dst:
+        reader = src.cursor()
+        writer = dst.cursor()
+        writer.execute("BEGIN")
+        try:
+            for table, columns in TABLES:
+                reader.execute("SELECT %s FROM %s"
+                               % (', '.join(columns), table))
+                insert = "INSERT INTO %s (%s) VALUES (%s)" % (
+                    table, ', '.join(columns), ', '.join('?' * len(columns))
+                )
+                copied = 0
+                while True:
+                    rows = reader.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    writer.executemany(insert, rows)
+                    copied += len(rows)
+                logger.info('copied %d rows of %s', copied, table)
+            # ids were copied as is, move the sequence past them
+            writer.execute("SELECT setval(pg_get_serial_sequence('outbox', "
+                           "'id'), COALESCE(max(id), 1)) FROM outbox")
+        except Exception:
+            writer.execute("ROLLBACK")
+            raise
+        writer.execute("COMMIT")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="copy sbfeed_bot data from sqlite3 to postgresql"
+    )
+    parser.add_argument("-d", "--database", metavar='FILE', required=True,
+                        help="sqlite3 database file to read")
+    parser.add_argument("--postgres", metavar='DSN', required=True,
+                        help="empty postgresql database to create "
+                             "the schema in and fill")
+    args = parser.parse_args()
+    logging.basicConfig(
+        level=logging.INFO, stream=sys.stderr,
+        format='%(asctime)-15s %(name)s %(levelname)s %(message)s'
+    )
+
+    from sbfeed_bot.pgmodel import SbFeedPgModel
+    source = SbFeedModel(args.database)
+    target = SbFeedPgModel(args.postgres)
+    try:
+        migrate(source, target)
+    finally:
+        source.close()
+        target.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,30 +1,176 @@
 import sqlite3
-import functools
-import time
-import logging
 import threading
+import contextlib
+import collections
 
-from sbfeed_bot import exceptions
+from sbfeed_bot.storage import SbFeedStorage, transaction, shard_key
 
 
-class SbFeedModel:
-    UPDATE_EVERY = 10
+StorageProfile = collections.namedtuple(
+    'StorageProfile',
+    'journal_mode synchronous cache_size mmap_size busy_timeout '
+    'cached_statements max_connections'
+)
 
-    def __init__(self, dbfile):
+STORAGE_PROFILES = {
+    # readers never wait for the writer, commits skip fsync of the wal
+    'wal': StorageProfile(journal_mode='WAL', synchronous='NORMAL',
+                          cache_size=-16384, mmap_size=256 * 1024 * 1024,
+                          busy_timeout=5000, cached_statements=256,
+                          max_connections=16),
+    # same, but every commit is fsync'ed
+    'durable': StorageProfile(journal_mode='WAL', synchronous='FULL',
+                              cache_size=-16384, mmap_size=256 * 1024 * 1024,
+                              busy_timeout=5000, cached_statements=256,
+                              max_connections=16),
+    # sqlite defaults
+    'legacy': StorageProfile(journal_mode='DELETE', synchronous='FULL',
+                             cache_size=-2000, mmap_size=0,
+                             busy_timeout=5000, cached_statements=128,
+                             max_connections=16),
+}
+
+
+class SbFeedModel(SbFeedStorage):
+    # readers run on query_only connections, so a deferred transaction
+    # only ever takes a read snapshot, while writers take the write lock
+    # upfront instead of failing to upgrade later
+    BEGIN_READONLY = "BEGIN DEFERRED"
+    BEGIN_WRITE = "BEGIN IMMEDIATE"
+
+    # each entry upgrades the schema by one PRAGMA user_version
+    MIGRATIONS = [
+        [
+            "ALTER TABLE feed ADD COLUMN etag varchar(255)",
+            "ALTER TABLE feed ADD COLUMN expires integer",
+        ],
+        [
+            # newest item of the feed, lets the notifier skip feeds and
+            # subscriptions with nothing new via idx_subscription_due
+            "ALTER TABLE feed ADD COLUMN last_pubdate integer",
+            "UPDATE feed SET last_pubdate = ("
+            "    SELECT max(pubdate) FROM feed_item WHERE feed = feed.slug"
+            ")",
+            "CREATE INDEX idx_subscription_due "
+            "ON subscription(feed, last_notified, chat_id)",
+        ],
+        [
+            "ALTER TABLE feed ADD COLUMN created integer",
+        ],
+        [
+            "ALTER TABLE feed ADD COLUMN next_fetch integer NOT NULL "
+            "DEFAULT 0",
+            "ALTER TABLE feed ADD COLUMN fetch_interval integer",
+            "ALTER TABLE feed ADD COLUMN fetch_errors integer NOT NULL "
+            "DEFAULT 0",
+            "CREATE INDEX idx_feed_next_fetch ON feed(next_fetch)",
+        ],
+        [
+            # feeds are split between worker processes by shard_key
+            "ALTER TABLE feed ADD COLUMN shard_key integer NOT NULL "
+            "DEFAULT 0",
+            "UPDATE feed SET shard_key = crc32(slug)",
+            """
+            CREATE TABLE shard_lease (
+                kind varchar(16),
+                shard integer,
+                owner varchar(255),
+                expires integer,
+                PRIMARY KEY (kind, shard)
+            )
+            """,
+        ],
+        [
+            # messages handed over by the notifier, until delivered
+            """
+            CREATE TABLE outbox (
+                id integer PRIMARY KEY,
+                key varchar(255) NOT NULL UNIQUE,
+                chat_id integer NOT NULL,
+                feed varchar(255) NOT NULL,
+                first_pubdate integer NOT NULL,
+                items text NOT NULL,
+                state varchar(16) NOT NULL DEFAULT 'pending',
+                attempts integer NOT NULL DEFAULT 0,
+                next_attempt real NOT NULL DEFAULT 0,
+                claimed_by varchar(255),
+                claimed_until real NOT NULL DEFAULT 0,
+                last_error text,
+                created integer
+            )
+            """,
+            "CREATE INDEX idx_outbox_due ON outbox(state, next_attempt)",
+            "CREATE INDEX idx_outbox_feed ON outbox(feed, first_pubdate)",
+        ],
+    ]
+    # free at most that many pages per incremental vacuum run
+    VACUUM_PAGES = 2048
+
+    def __init__(self, dbfile, profile=STORAGE_PROFILES['wal'],
+                 schedule=None, events=None):
+        super().__init__(schedule=schedule, events=events)
         self.dbfile = dbfile
-        self.connections = {}
-        self.logger = logging.getLogger("sbfeed.model")
+        self.profile = profile
+        # readers and writers are kept apart, so that query_only is set
+        # once per connection rather than toggled per transaction
+        self.idle_connections = {False: [], True: []}
+        self.connection_slots = threading.BoundedSemaphore(
+            profile.max_connections
+        )
+        self.lock = threading.Lock()
 
-    def _get_connection(self):
-        tid = threading.get_ident()
-        if tid not in self.connections:
-            conn = sqlite3.connect(self.dbfile, isolation_level=None)
-            conn.execute("PRAGMA foreign_keys = ON;")
-            self.connections[tid] = conn
-        return self.connections[tid]
+    def _connect(self, readonly):
+        profile = self.profile
+        conn = sqlite3.connect(self.dbfile, isolation_level=None,
+                               timeout=profile.busy_timeout / 1000,
+                               cached_statements=profile.cached_statements,
+                               check_same_thread=False)
+        conn.execute("PRAGMA foreign_keys = ON;")
+        conn.execute("PRAGMA journal_mode = %s;" % (profile.journal_mode, ))
+        conn.execute("PRAGMA synchronous = %s;" % (profile.synchronous, ))
+        conn.execute("PRAGMA cache_size = %d;" % (profile.cache_size, ))
+        conn.execute("PRAGMA mmap_size = %d;" % (profile.mmap_size, ))
+        conn.execute("PRAGMA busy_timeout = %d;" % (profile.busy_timeout, ))
+        if readonly:
+            # any write fails with "attempt to write a readonly database"
+            conn.execute("PRAGMA query_only = ON;")
+        conn.create_function('crc32', 1, shard_key, deterministic=True)
+        return conn
+
+    @contextlib.contextmanager
+    def _connection(self, readonly=False):
+        # connections are shared between threads, but only one at a time
+        idle = self.idle_connections[readonly]
+        with self.connection_slots:
+            with self.lock:
+                conn = idle.pop() if idle else None
+            if conn is None:
+                conn = self._connect(readonly)
+            try:
+                yield conn
+            finally:
+                if conn.in_transaction:
+                    conn.close()
+                else:
+                    with self.lock:
+                        idle.append(conn)
+
+    def close(self):
+        with self.lock:
+            for idle in self.idle_connections.values():
+                while idle:
+                    idle.pop().close()
 
     def create_db(self):
-        conn = self._get_connection()
+        with self._connection() as conn:
+            # setting the journal mode on connect already wrote the file
+            # header, so this needs a vacuum, instant on an empty database
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM")
+            self._create_tables(conn)
+        self.upgrade_db()
+
+    def _create_tables(self, conn):
         conn.execute("""
             CREATE TABLE feed (
                 slug varchar(255),
@@ -57,149 +203,77 @@ class SbFeedModel:
             CREATE INDEX idx_subscription_chat_id ON subscription(chat_id);
         """)
 
-    def transaction(*, readonly):
-        def wrapper(meth):
-            @functools.wraps(meth)
-            def wrapped(self, *args, **kwargs):
-                cursor = self._get_connection().cursor()
-                self.logger.debug("trying to %s(*%r, **%r)",
-                                  meth.__name__, args, kwargs)
-                cursor.execute("BEGIN TRANSACTION")
-                try:
-                    result = meth(self, cursor, *args, **kwargs)
-                except Exception as exc:
-                    self.logger.info("%s() failed with: %s",
-                                     meth.__name__, exc)
-                    cursor.execute("ROLLBACK")
-                    raise
-                else:
-                    self.logger.debug("%s(*%r, **%r) -> %r",
-                                      meth.__name__, args, kwargs, result)
-                    cursor.execute("COMMIT")
-                    return result
-            return wrapped
-        return wrapper
+    def upgrade_db(self):
+        with self._connection() as conn:
+            self._upgrade_db(conn)
 
-    @transaction(readonly=True)
-    def check_feed_is_known(self, cursor, feed):
-        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
-        return bool(cursor.fetchone())
-
-    @transaction(readonly=False)
-    def init_feed(self, cursor, feed):
-        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
-        if cursor.fetchone():
-            raise exceptions.AlreadyExistsError()
-        cursor.execute(
-            "INSERT INTO feed (slug, last_modified, last_tried_to_fetch) "
-            "VALUES (?, NULL, NULL)",
-            [feed]
-        )
+    def _upgrade_db(self, conn):
+        [current] = conn.execute("PRAGMA user_version").fetchone()
+        for version in range(current, len(self.MIGRATIONS)):
+            self.logger.info("upgrading database schema to version %d",
+                             version + 1)
+            conn.execute("BEGIN TRANSACTION")
+            try:
+                for statement in self.MIGRATIONS[version]:
+                    conn.execute(statement)
+                conn.execute("PRAGMA user_version = %d" % (version + 1, ))
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        [auto_vacuum] = conn.execute("PRAGMA auto_vacuum").fetchone()
+        if auto_vacuum != 2:
+            self.logger.warning("incremental vacuum is off, pruned data "
+                                "is not given back to the filesystem; run "
+                                "once with --rebuild-db to turn it on")
 
-    @transaction(readonly=False)
-    def store_item(self, cursor, feed, item_title, item_link, item_text,
-                   item_pub_date):
-        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
-        if not cursor.fetchone():
-            raise exceptions.NotExistError()
-        cursor.execute(
-            "INSERT INTO feed_item (feed, title, link, text, pubdate) "
-            "VALUES (?, ?, ?, ?, ?)",
-            [feed, item_title, item_link, item_text, item_pub_date]
-        )
+    def rebuild_db(self):
+        # auto_vacuum only changes on an empty database or with a full
+        # vacuum, which rewrites the whole file while holding it locked
+        # and needs as much free disk space as the database takes
+        with self._connection() as conn:
+            self.logger.info("rebuilding the database with incremental "
+                             "vacuum")
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL;")
+            conn.execute("VACUUM")
 
-    @transaction(readonly=False)
-    def mark_feed_as_processed(self, cursor, feed, *, last_modified):
-        now = time.time()
-        if last_modified is None:
-            cursor.execute(
-                "UPDATE feed SET last_tried_to_fetch = ? "
-                "WHERE slug = ?",
-                [now, feed]
-            )
-        else:
-            cursor.execute(
-                "UPDATE feed SET last_modified = ?, last_tried_to_fetch = ? "
-                "WHERE slug = ? ",
-                [last_modified, now, feed]
+    def vacuum(self):
+        with self._connection() as conn:
+            # execute() stops after the first freed page, executescript()
+            # runs the pragma to completion
+            conn.executescript(
+                "PRAGMA incremental_vacuum(%d);" % (self.VACUUM_PAGES, )
             )
-        if not cursor.rowcount:
-            raise exceptions.NotExistError()
-
-    @transaction(readonly=False)
-    def subscribe(self, cursor, chat_id, feed):
-        cursor.execute("SELECT 1 FROM subscription WHERE "
-                       "chat_id = ? AND feed = ?", [chat_id, feed])
-        if cursor.fetchone():
-            raise exceptions.AlreadyExistsError()
-        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
-        if not cursor.fetchone():
-            raise exceptions.NotExistError()
-        cursor.execute(
-            "INSERT INTO subscription (chat_id, feed, last_notified) "
-            "VALUES (?, ?, ?)",
-            [chat_id, feed, int(time.time())]
-        )
-
-    @transaction(readonly=True)
-    def list_subscriptions(self, cursor, chat_id):
-        cursor.execute("SELECT feed FROM subscription WHERE "
-                       "chat_id = ? ORDER BY feed", [chat_id])
-        feeds = [row[0] for row in cursor.fetchall()]
-        return feeds
-
-    @transaction(readonly=False)
-    def unsubscribe(self, cursor, chat_id, feed):
-        cursor.execute("SELECT 1 FROM subscription WHERE "
-                       "chat_id = ? AND feed = ?", [chat_id, feed])
-        if not cursor.fetchone():
-            raise exceptions.NotExistError()
-        cursor.execute("DELETE FROM subscription WHERE "
-                       "chat_id = ? AND feed = ?", [chat_id, feed])
-
-    @transaction(readonly=False)
-    def unsubscribe_all(self, cursor, chat_id):
-        cursor.execute("SELECT 1 FROM subscription WHERE "
-                       "chat_id = ? LIMIT 1", [chat_id])
-        if not cursor.fetchone():
-            raise exceptions.NotExistError()
-        cursor.execute("DELETE FROM subscription WHERE "
-                       "chat_id = ?", [chat_id])
+            [free_pages] = conn.execute("PRAGMA freelist_count").fetchone()
+        return free_pages
 
     @transaction(readonly=True)
-    def get_fetches_needed(self, cursor):
-        cursor.execute(
-            "SELECT slug, last_modified, last_tried_to_fetch "
-            "FROM feed "
-            "WHERE last_tried_to_fetch IS NULL OR last_tried_to_fetch + ? < ?",
-            [self.UPDATE_EVERY, time.time()]
-        )
-        return cursor.fetchall()
-
-    @transaction(readonly=True)
-    def check_notifications_needed(self, cursor):
+    def check_notifications_needed(self, cursor, limit=10, after=None,
+                                   shards=None):
+        # keyset pagination: pass (feed, chat_id, item_pub_date)
+        # of the last row seen to get the next page; rows only carry
+        # keys, contents are looked up once per item with get_items()
+        params = ['' if after is None else after[0]]
+        keyset = ''
+        if after is not None:
+            keyset = "AND (su.feed, su.chat_id, fi.pubdate) > (?, ?, ?)"
+            params.extend(after)
+        keyset += self._shard_filter("abs(su.chat_id)", shards, params)
+        params.append(limit)
+        # CROSS JOIN pins the join order: feeds, then due subscriptions
+        # of each feed, then their pending items, all by index range scans
         cursor.execute("""
-            SELECT su.chat_id, fi.feed, fi.title, fi.link, fi.text, fi.pubdate
-            FROM subscription AS su
-            JOIN feed_item AS fi ON (fi.feed = su.feed)
-            WHERE su.last_notified < fi.pubdate
-            ORDER BY fi.feed, fi.pubdate
-            LIMIT 10
-        """)
+            SELECT su.chat_id, fi.feed, fi.pubdate
+            FROM feed AS f
+            CROSS JOIN subscription AS su INDEXED BY idx_subscription_due
+                ON (su.feed = f.slug AND su.last_notified < f.last_pubdate)
+            CROSS JOIN feed_item AS fi
+                ON (fi.feed = su.feed AND fi.pubdate > su.last_notified)
+            WHERE f.slug >= ? %s
+            ORDER BY su.feed, su.chat_id, fi.pubdate
+            LIMIT ?
+        """ % (keyset, ), params)
         return [{'chat_id': row[0],
                  'feed': row[1],
-                 'item_title': row[2],
-                 'item_link': row[3],
-                 'item_text': row[4],
-                 'item_pub_date': row[5]}
+                 'item_pub_date': row[2]}
                 for row in cursor.fetchall()]
-
-    @transaction(readonly=False)
-    def mark_notification_as_sent(self, cursor, chat_id, feed, item_pub_date):
-        cursor.execute("UPDATE subscription SET last_notified = ? "
-                       "WHERE feed = ? AND chat_id = ? AND last_notified < ?",
-                       [item_pub_date, feed, chat_id, item_pub_date])
-        if not cursor.rowcount:
-            raise exceptions.NotExistError()
-
-    del transaction
@@ -0,0 +1,449 @@
+import os
+import time
+import socket
+import logging
+import threading
+import collections
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from telegram.error import RetryAfter, Unauthorized, BadRequest
+
+from sbfeed_bot import metrics
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity,
+                          self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        # takes a token in advance, returns how long to wait until it is due
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens = min(self.tokens, -seconds * self.rate)
+
+    def set_rate(self, rate):
+        with self.lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def is_idle(self, now):
+        with self.lock:
+            return (self.tokens >= self.capacity
+                    or self.tokens + (now - self.updated) * self.rate
+                    >= self.capacity)
+
+
+class RenderCache:
+    # least recently used rendered messages, by (feed, pubdate)
+    def __init__(self, size):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            text = self.entries.get(key)
+            if text is not None:
+                self.entries.move_to_end(key)
+            return text
+
+    def put(self, key, text):
+        with self.lock:
+            self.entries[key] = text
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+
+class SbFeedNotifier:
+    # telegram allows about a message per second in a private chat
+    # and 20 messages per minute in a group
+    PRIVATE_CHAT_RATE = 1.0
+    GROUP_CHAT_RATE = 20 / 60
+    CHAT_BURST = 3
+    # flood control waits in a row before a message counts as failed
+    MAX_ATTEMPTS = 5
+
+    # outcomes of a delivery attempt
+    SENT = 'sent'
+    RETRY = 'retry'
+    FAILED = 'failed'
+    REJECTED = 'rejected'
+    BLOCKED = 'blocked'
+    DEFERRED = 'deferred'
+    UNAUTHORIZED = 'unauthorized'
+    # outcomes that let the next message of the chat go
+    DELIVERED = frozenset([SENT, REJECTED])
+
+    # claimed outbox messages go back to the queue after that long
+    OUTBOX_LEASE = 900
+    OUTBOX_MAX_ATTEMPTS = 8
+    RETRY_DELAY = 5
+    MAX_RETRY_DELAY = 600
+    # delivery stops for that long once telegram rejects the bot token
+    TOKEN_PAUSE = 60
+
+    def __init__(self, model, bot, *, concurrency, rate, batch_size,
+                 lease=None, digest_window=None, render_cache_size=1024):
+        self.model = model
+        self.bot = bot
+        # a fan-out renders every item once rather than once per chat
+        self.render_cache = RenderCache(render_cache_size)
+        self.lease = lease
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.batch_size = batch_size
+        # with a window, items of a subscription are sent together once
+        # the oldest one is that many seconds old
+        self.digest_window = digest_window
+        self.next_digest = None
+        self.next_retry = None
+        self.paused_until = None
+        self.logger = logging.getLogger('sbfeed.notifier')
+        self.executor = ThreadPoolExecutor(max_workers=concurrency,
+                                           thread_name_prefix='notifier')
+        self.max_rate = rate
+        self.global_bucket = TokenBucket(rate, capacity=max(1, rate))
+        self.chat_buckets = {}
+        self.lock = threading.Lock()
+        self.position = None
+
+    def chat_bucket(self, chat_id):
+        with self.lock:
+            bucket = self.chat_buckets.get(chat_id)
+            if bucket is None:
+                rate = (self.GROUP_CHAT_RATE if chat_id < 0
+                        else self.PRIVATE_CHAT_RATE)
+                bucket = TokenBucket(rate, capacity=self.CHAT_BURST)
+                self.chat_buckets[chat_id] = bucket
+            return bucket
+
+    def _forget_idle_chats(self):
+        now = time.monotonic()
+        with self.lock:
+            for chat_id, bucket in list(self.chat_buckets.items()):
+                if bucket.is_idle(now):
+                    del self.chat_buckets[chat_id]
+
+    def _slow_down(self, chat_id, retry_after):
+        self.logger.warning('hit flood control in chat %d, retry after %ss',
+                            chat_id, retry_after)
+        self.chat_bucket(chat_id).pause(retry_after)
+        self.global_bucket.set_rate(max(1, self.global_bucket.rate / 2))
+
+    def _speed_up(self):
+        if self.global_bucket.rate < self.max_rate:
+            self.global_bucket.set_rate(min(
+                self.max_rate, self.global_bucket.rate + self.max_rate / 100
+            ))
+
+    def next_batch(self):
+        while True:
+            if self.position is None:
+                self.next_digest = None
+            items = self.model.check_notifications_needed(
+                limit=self.batch_size, after=self.position,
+                shards=self.lease.shards('notify') if self.lease else None,
+            )
+            metrics.NOTIFY_BATCH.set(len(items))
+            if not items:
+                if self.position is None:
+                    return []
+                # reached the end of the backlog, start over unless
+                # there are digests to wait for
+                self.position = None
+                if self.next_digest is not None:
+                    return []
+                continue
+            if self.digest_window is None:
+                last = items[-1]
+                self.position = (last['feed'], last['chat_id'],
+                                 last['item_pub_date'])
+                return items
+            items = self._hold_back_digests(items)
+            if items:
+                return items
+
+    def _hold_back_digests(self, items):
+        by_subscription = collections.OrderedDict()
+        for item in items:
+            key = (item['feed'], item['chat_id'])
+            by_subscription.setdefault(key, []).append(item)
+        groups = list(by_subscription.values())
+        if len(items) == self.batch_size and len(groups) > 1:
+            # the last subscription may continue on the next page
+            groups.pop()
+        last = groups[-1][-1]
+        self.position = (last['feed'], last['chat_id'],
+                         last['item_pub_date'])
+        now = time.time()
+        ready = []
+        for group in groups:
+            due = group[0]['item_pub_date'] + self.digest_window
+            if due <= now:
+                ready.extend(group)
+            elif self.next_digest is None or due < self.next_digest:
+                self.next_digest = due
+        return ready
+
+    def wait_time(self, idle_wait):
+        # how long to sleep when there is nothing to send right now
+        if self.next_retry is not None and self.next_retry <= time.time():
+            self.next_retry = None
+        deadlines = [deadline for deadline in (self.next_digest,
+                                               self.next_retry)
+                     if deadline is not None]
+        if not deadlines:
+            return idle_wait
+        return max(0, min(idle_wait, min(deadlines) - time.time()))
+
+    def render(self, keys):
+        # keys are (feed, pubdate) pairs, items that are gone map to None
+        texts = {}
+        missing = set()
+        for key in keys:
+            if key not in texts:
+                texts[key] = self.render_cache.get(key)
+                if texts[key] is None:
+                    missing.add(key)
+        if missing:
+            for (feed, pubdate), item in self.model.get_items(
+                    sorted(missing)).items():
+                text = self.bot.render(feed, item['item_title'],
+                                       item['item_link'], item['item_text'],
+                                       pubdate)
+                self.render_cache.put((feed, pubdate), text)
+                texts[feed, pubdate] = text
+        return texts
+
+    def enqueue(self, items):
+        # turns pending items into messages and moves them to the outbox
+        by_subscription = collections.OrderedDict()
+        for item in items:
+            key = (item['chat_id'], item['feed'])
+            by_subscription.setdefault(key, []).append(item['item_pub_date'])
+        if self.digest_window is not None:
+            texts = self.render((item['feed'], item['item_pub_date'])
+                                for item in items)
+        messages = []
+        for (chat_id, feed), pubdates in by_subscription.items():
+            if self.digest_window is None:
+                messages.extend((chat_id, feed, [pubdate])
+                                for pubdate in pubdates)
+                continue
+            pubdates = [pubdate for pubdate in pubdates
+                        if texts[feed, pubdate] is not None]
+            start = 0
+            for _, count in self.bot.pack_digest(
+                    [texts[feed, pubdate] for pubdate in pubdates]):
+                messages.append((chat_id, feed,
+                                 pubdates[start:start + count]))
+                start += count
+        return self.model.enqueue_notifications(messages, [
+            (chat_id, feed, max(pubdates))
+            for (chat_id, feed), pubdates in by_subscription.items()
+        ])
+
+    def is_paused(self):
+        with self.lock:
+            if self.paused_until is None:
+                return False
+            if self.paused_until > time.time():
+                return True
+            self.paused_until = None
+            return False
+
+    def _pause(self):
+        with self.lock:
+            self.paused_until = time.time() + self.TOKEN_PAUSE
+            return self.paused_until
+
+    def claim(self):
+        if self.is_paused():
+            return []
+        return self.model.claim_outbox(
+            self.owner, self.batch_size, self.OUTBOX_LEASE,
+            shards=self.lease.shards('notify') if self.lease else None,
+        )
+
+    def group_by_chat(self, messages):
+        # renders claimed messages, grouped by chat
+        texts = self.render((message['feed'], pubdate)
+                            for message in messages
+                            for pubdate in message['pubdates'])
+        by_chat = collections.OrderedDict()
+        for message in messages:
+            parts = [texts[message['feed'], pubdate]
+                     for pubdate in message['pubdates']
+                     if texts[message['feed'], pubdate] is not None]
+            message['text'] = self.bot.join_digest(parts) if parts else None
+            by_chat.setdefault(message['chat_id'], []).append(message)
+        return list(by_chat.values())
+
+    def _retry_delay(self, attempts):
+        return min(self.RETRY_DELAY * 2 ** (attempts - 1),
+                   self.MAX_RETRY_DELAY)
+
+    def complete_delivery(self, results):
+        self._forget_idle_chats()
+        now = time.time()
+        updates = []
+        blocked = set()
+        for message, outcome in results:
+            attempts = message['attempts']
+            error = message.get('error')
+            if outcome == self.SENT:
+                updates.append((message['id'], 'sent', attempts + 1, now,
+                                None))
+            elif outcome == self.REJECTED:
+                updates.append((message['id'], 'failed', attempts + 1, now,
+                                error))
+            elif outcome == self.BLOCKED:
+                blocked.add(message['chat_id'])
+            elif outcome == self.DEFERRED:
+                # stays behind the failed message of its chat
+                updates.append((message['id'], 'pending', attempts, now,
+                                None))
+            elif outcome == self.UNAUTHORIZED:
+                # not the message's fault, try again once unpaused
+                next_attempt = self.paused_until or now
+                if self.next_retry is None or next_attempt < self.next_retry:
+                    self.next_retry = next_attempt
+                updates.append((message['id'], 'pending', attempts,
+                                next_attempt, None))
+            elif attempts + 1 >= self.OUTBOX_MAX_ATTEMPTS:
+                self.logger.error('giving up on notifying %d after %d '
+                                  'attempts', message['chat_id'],
+                                  attempts + 1)
+                updates.append((message['id'], 'failed', attempts + 1, now,
+                                error))
+            else:
+                next_attempt = now + self._retry_delay(attempts + 1)
+                if self.next_retry is None or next_attempt < self.next_retry:
+                    self.next_retry = next_attempt
+                updates.append((message['id'], 'pending', attempts + 1,
+                                next_attempt, error))
+        for chat_id in blocked:
+            self.logger.info('chat %d blocked the bot or is gone, '
+                             'unsubscribing it', chat_id)
+            self.model.forget_chat(chat_id)
+        if updates:
+            self.model.finish_outbox(self.owner, updates)
+
+    def run_once(self):
+        items = self.next_batch()
+        if items:
+            self.enqueue(items)
+        messages = self.claim()
+        # messages of one chat go strictly in order, chats go in parallel
+        futures = [self.executor.submit(self._deliver_chat, chat_messages)
+                   for chat_messages in self.group_by_chat(messages)]
+        wait(futures)
+        self.complete_delivery([result for future in futures
+                                for result in future.result()])
+        return len(items) + len(messages)
+
+    def _deliver_chat(self, messages):
+        results = []
+        for message in messages:
+            try:
+                outcome = self._deliver(message)
+            except Exception:
+                self.logger.exception('failed to deliver %r', message)
+                outcome = self.FAILED
+            results.append((message, outcome))
+            if outcome not in self.DELIVERED:
+                results.extend((rest, self.DEFERRED)
+                               for rest in messages[len(results):])
+                break
+        return results
+
+    def _deliver(self, message):
+        for attempt in range(self.MAX_ATTEMPTS):
+            self.chat_bucket(message['chat_id']).acquire()
+            self.global_bucket.acquire()
+            outcome = self.send(message)
+            if outcome != self.RETRY:
+                return outcome
+        self.logger.warning('hit flood control in chat %d %d times in a row',
+                            message['chat_id'], attempt + 1)
+        return self.FAILED
+
+    def send(self, message):
+        if self.is_paused():
+            return self.UNAUTHORIZED
+        if message['text'] is None:
+            message['error'] = 'items are gone'
+            return self.REJECTED
+        self.logger.info('need to notify %d about feed %r',
+                         message['chat_id'], message['feed'])
+        try:
+            with metrics.SEND_SECONDS.time():
+                self.bot.send_text(message['chat_id'], message['text'])
+        except RetryAfter as exc:
+            metrics.SEND_RESULTS.inc('retry_after')
+            self._slow_down(message['chat_id'], exc.retry_after)
+            return self.RETRY
+        except Unauthorized:
+            return self._unauthorized(message)
+        except BadRequest as exc:
+            if 'chat not found' in str(exc).lower():
+                metrics.SEND_RESULTS.inc('blocked')
+                return self.BLOCKED
+            metrics.SEND_RESULTS.inc('rejected')
+            self.logger.error('telegram rejected a message to %d: %s',
+                              message['chat_id'], exc)
+            message['error'] = str(exc)
+            return self.REJECTED
+        except Exception as exc:
+            metrics.SEND_RESULTS.inc('error')
+            self.logger.exception('failed to notify')
+            message['error'] = str(exc)
+            return self.FAILED
+        metrics.SEND_RESULTS.inc('sent')
+        self.logger.info('notified successfully')
+        self._speed_up()
+        return self.SENT
+
+    def _unauthorized(self, message):
+        # only forget the chat once getMe proves the token still works
+        try:
+            token_is_valid = self.bot.token_is_valid()
+        except Exception as exc:
+            metrics.SEND_RESULTS.inc('error')
+            self.logger.warning('failed to check the bot token: %s', exc)
+            message['error'] = 'unauthorized, token check failed: %s' % (
+                exc, )
+            return self.FAILED
+        if token_is_valid:
+            metrics.SEND_RESULTS.inc('blocked')
+            return self.BLOCKED
+        metrics.SEND_RESULTS.inc('unauthorized')
+        self._pause()
+        self.logger.critical('telegram rejected the bot token, pausing '
+                             'delivery for %ds', self.TOKEN_PAUSE)
+        return self.UNAUTHORIZED
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
@@ -0,0 +1,288 @@
+import time
+import threading
+import contextlib
+
+from psycopg2.pool import ThreadedConnectionPool
+
+from sbfeed_bot.storage import SbFeedStorage, transaction
+
+
+class PgCursor:
+    # runs queries written for sqlite3, with ? placeholders, on psycopg2
+    def __init__(self, cursor):
+        self.cursor = cursor
+        self.rowcount = -1
+
+    def _translate(self, query):
+        return query.replace('%', '%%').replace('?', '%s')
+
+    def execute(self, query, params=None):
+        if params is None:
+            self.cursor.execute(query)
+        else:
+            self.cursor.execute(self._translate(query), params)
+        self.rowcount = self.cursor.rowcount
+
+    def executemany(self, query, seq_of_params):
+        query = self._translate(query)
+        rowcount = 0
+        for params in seq_of_params:
+            self.cursor.execute(query, params)
+            rowcount += self.cursor.rowcount
+        self.rowcount = rowcount
+
+    def fetchone(self):
+        return self.cursor.fetchone()
+
+    def fetchall(self):
+        return self.cursor.fetchall()
+
+    def fetchmany(self, size):
+        return self.cursor.fetchmany(size)
+
+
+class PgConnection:
+    def __init__(self, conn):
+        self.conn = conn
+
+    def cursor(self):
+        return PgCursor(self.conn.cursor())
+
+
+class SbFeedPgModel(SbFeedStorage):
+    BEGIN_READONLY = "BEGIN READ ONLY"
+    BEGIN_WRITE = "BEGIN"
+
+    SCHEMA = [
+        """
+        CREATE TABLE feed (
+            slug varchar(255),
+            last_modified bigint,
+            last_tried_to_fetch double precision,
+            etag varchar(255),
+            expires bigint,
+            last_pubdate bigint,
+            created bigint,
+            next_fetch double precision NOT NULL DEFAULT 0,
+            fetch_interval bigint,
+            fetch_errors integer NOT NULL DEFAULT 0,
+            shard_key bigint NOT NULL DEFAULT 0,
+            PRIMARY KEY (slug)
+        )
+        """,
+        "CREATE INDEX idx_feed_next_fetch ON feed(next_fetch)",
+        """
+        CREATE TABLE feed_item (
+            feed varchar(255),
+            title text,
+            link varchar(255),
+            text text,
+            pubdate bigint,
+            PRIMARY KEY (feed, pubdate),
+            FOREIGN KEY (feed) REFERENCES feed (slug) ON DELETE CASCADE
+        )
+        """,
+        """
+        CREATE TABLE subscription (
+            chat_id bigint,
+            feed varchar(255),
+            last_notified bigint,
+            claimed_until double precision NOT NULL DEFAULT 0,
+            PRIMARY KEY (feed, chat_id),
+            FOREIGN KEY (feed) REFERENCES feed (slug) ON DELETE RESTRICT
+        )
+        """,
+        "CREATE INDEX idx_subscription_chat_id ON subscription(chat_id)",
+        "CREATE INDEX idx_subscription_due "
+        "ON subscription(feed, last_notified, chat_id)",
+        """
+        CREATE TABLE shard_lease (
+            kind varchar(16),
+            shard integer,
+            owner varchar(255),
+            expires bigint,
+            PRIMARY KEY (kind, shard)
+        )
+        """,
+        "CREATE TABLE schema_version (version integer NOT NULL)",
+    ]
+    # upgrades of SCHEMA, each entry bumps schema_version by one
+    MIGRATIONS = [
+        [
+            """
+            CREATE TABLE outbox (
+                id bigserial,
+                key varchar(255) NOT NULL UNIQUE,
+                chat_id bigint NOT NULL,
+                feed varchar(255) NOT NULL,
+                first_pubdate bigint NOT NULL,
+                items text NOT NULL,
+                state varchar(16) NOT NULL DEFAULT 'pending',
+                attempts integer NOT NULL DEFAULT 0,
+                next_attempt double precision NOT NULL DEFAULT 0,
+                claimed_by varchar(255),
+                claimed_until double precision NOT NULL DEFAULT 0,
+                last_error text,
+                created bigint,
+                PRIMARY KEY (id)
+            )
+            """,
+            "CREATE INDEX idx_outbox_due ON outbox(state, next_attempt)",
+            "CREATE INDEX idx_outbox_feed ON outbox(feed, first_pubdate)",
+        ],
+    ]
+
+    # feeds and subscriptions handed out to a host are hidden from
+    # the others until processed, or for that long
+    FETCH_LEASE = 300
+    NOTIFY_LEASE = 300
+    FETCH_BATCH = 100
+
+    def __init__(self, dsn, max_connections=16, schedule=None, events=None):
+        super().__init__(schedule=schedule, events=events)
+        self.dsn = dsn
+        self.pool = ThreadedConnectionPool(1, max_connections, dsn)
+        # the pool raises instead of waiting when exhausted
+        self.connection_slots = threading.BoundedSemaphore(max_connections)
+
+    @contextlib.contextmanager
+    def _connection(self, readonly=False):
+        # read-only transactions are enforced by BEGIN_READONLY
+        with self.connection_slots:
+            conn = self.pool.getconn()
+            # transactions are opened and closed explicitly
+            conn.autocommit = True
+            try:
+                yield PgConnection(conn)
+            finally:
+                self.pool.putconn(conn, close=bool(conn.closed))
+
+    def close(self):
+        self.pool.closeall()
+
+    def _run_script(self, conn, statements):
+        cursor = conn.cursor()
+        cursor.execute("BEGIN")
+        try:
+            for statement in statements:
+                cursor.execute(statement)
+        except Exception:
+            cursor.execute("ROLLBACK")
+            raise
+        cursor.execute("COMMIT")
+
+    def create_db(self):
+        with self._connection() as conn:
+            self._run_script(conn, self.SCHEMA + [
+                "INSERT INTO schema_version VALUES (0)",
+            ])
+        self.upgrade_db()
+
+    def upgrade_db(self):
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT version FROM schema_version")
+            [current] = cursor.fetchone()
+            for version in range(current, len(self.MIGRATIONS)):
+                self.logger.info("upgrading database schema to version %d",
+                                 version + 1)
+                self._run_script(conn, self.MIGRATIONS[version] + [
+                    "UPDATE schema_version SET version = %d" % (version + 1, ),
+                ])
+
+    def vacuum(self):
+        # autovacuum takes care of it
+        return 0
+
+    @transaction(readonly=False)
+    def get_fetches_needed(self, cursor, shards=None):
+        # claims due feeds, so that every one is fetched by one host only
+        now = time.time()
+        params = [now + self.FETCH_LEASE, now]
+        shard_filter = self._shard_filter("shard_key", shards, params)
+        params.append(self.FETCH_BATCH)
+        cursor.execute(
+            "UPDATE feed SET next_fetch = ? "
+            "WHERE slug IN ("
+            "    SELECT slug FROM feed "
+            "    WHERE next_fetch <= ? %s "
+            "    ORDER BY next_fetch LIMIT ? "
+            "    FOR UPDATE SKIP LOCKED"
+            ") "
+            "RETURNING slug, last_modified, last_tried_to_fetch, etag"
+            % (shard_filter, ),
+            params
+        )
+        return cursor.fetchall()
+
+    @transaction(readonly=False)
+    def claim_outbox(self, cursor, owner, limit, lease, shards=None):
+        now = time.time()
+        params = [owner, now + lease, now, now, now]
+        shard_filter = self._shard_filter("abs(chat_id)", shards, params)
+        params.append(limit)
+        cursor.execute(
+            "UPDATE outbox SET claimed_by = ?, claimed_until = ? "
+            "WHERE id IN ("
+            "    SELECT id FROM outbox "
+            "    WHERE state = 'pending' AND next_attempt <= ? "
+            "    AND claimed_until <= ? "
+            "    AND chat_id NOT IN ("
+            "        SELECT chat_id FROM outbox "
+            "        WHERE state = 'pending' AND next_attempt > ?"
+            "    ) %s "
+            "    ORDER BY id LIMIT ? "
+            "    FOR UPDATE SKIP LOCKED"
+            ") "
+            "RETURNING id, chat_id, feed, items, attempts" % (shard_filter, ),
+            params
+        )
+        return [self._outbox_message(row)
+                for row in sorted(cursor.fetchall())]
+
+    @transaction(readonly=False)
+    def check_notifications_needed(self, cursor, limit=10, after=None,
+                                   shards=None):
+        # claims due subscriptions until enqueue_notifications(),
+        # which makes paging with after unnecessary
+        now = time.time()
+        params = [now]
+        shard_filter = self._shard_filter("abs(su.chat_id)", shards, params)
+        params.extend([limit, now + self.NOTIFY_LEASE])
+        cursor.execute("""
+            WITH due AS (
+                SELECT su.feed, su.chat_id
+                FROM feed AS f
+                JOIN subscription AS su
+                    ON (su.feed = f.slug AND su.last_notified < f.last_pubdate)
+                WHERE su.claimed_until <= ? %s
+                ORDER BY su.feed, su.chat_id
+                LIMIT ?
+                FOR UPDATE OF su SKIP LOCKED
+            ), claimed AS (
+                UPDATE subscription AS su SET claimed_until = ?
+                FROM due
+                WHERE su.feed = due.feed AND su.chat_id = due.chat_id
+                RETURNING su.chat_id, su.feed, su.last_notified
+            )
+            SELECT cl.chat_id, fi.feed, fi.pubdate
+            FROM claimed AS cl
+            JOIN feed_item AS fi
+                ON (fi.feed = cl.feed AND fi.pubdate > cl.last_notified)
+            ORDER BY cl.feed, cl.chat_id, fi.pubdate
+        """ % (shard_filter, ), params)
+        return [{'chat_id': row[0],
+                 'feed': row[1],
+                 'item_pub_date': row[2]}
+                for row in cursor.fetchall()]
+
+    def _advance_subscriptions(self, cursor, notifications):
+        cursor.executemany(
+            "UPDATE subscription "
+            "SET last_notified = GREATEST(last_notified, ?), "
+            "claimed_until = 0 "
+            "WHERE feed = ? AND chat_id = ?",
+            [(item_pub_date, feed, chat_id)
+             for chat_id, feed, item_pub_date in notifications]
+        )
+        return cursor.rowcount
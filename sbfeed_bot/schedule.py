@@ -0,0 +1,27 @@
+import math
+
+
+class SbFeedSchedule:
+    # quiet feeds are polled this much less often after every fetch
+    # that brought nothing new
+    GROWTH = 1.5
+
+    def __init__(self, *, min_interval=10, max_interval=3600,
+                 error_interval=30, max_error_interval=6 * 3600):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.error_interval = error_interval
+        self.max_error_interval = max_error_interval
+
+    def next_interval(self, interval, changed, subscribers):
+        if changed or not interval:
+            interval = self.min_interval
+        else:
+            interval *= self.GROWTH
+        # the more people wait for a feed, the sooner it is rechecked
+        limit = self.max_interval / (1 + math.log2(1 + subscribers))
+        return int(max(self.min_interval, min(interval, limit)))
+
+    def retry_interval(self, errors):
+        return int(min(self.error_interval * 2 ** (errors - 1),
+                       self.max_error_interval))
@@ -0,0 +1,33 @@
+import os
+import socket
+import logging
+
+
+class SbFeedShardLease:
+    KINDS = ('fetch', 'notify')
+
+    def __init__(self, model, *, index, total, ttl):
+        self.model = model
+        self.index = index
+        self.total = total
+        self.ttl = ttl
+        self.owner = '%s:%d' % (socket.gethostname(), os.getpid())
+        self.owned = {kind: frozenset() for kind in self.KINDS}
+        self.logger = logging.getLogger('sbfeed.sharding')
+
+    def shards(self, kind):
+        return self.total, self.owned[kind]
+
+    def renew(self):
+        owned = self.model.renew_leases(self.owner, self.index, self.KINDS,
+                                        self.total, self.ttl)
+        if owned != self.owned:
+            self.logger.info('worker %d now owns %s', self.index, ', '.join(
+                '%s shards %s' % (kind, sorted(owned[kind]))
+                for kind in self.KINDS
+            ))
+        self.owned = owned
+
+    def release(self):
+        self.model.release_leases(self.owner)
+        self.owned = {kind: frozenset() for kind in self.KINDS}
@@ -0,0 +1,424 @@
+import zlib
+import time
+import logging
+import functools
+
+from sbfeed_bot import exceptions, metrics
+from sbfeed_bot.schedule import SbFeedSchedule
+
+
+def shard_key(slug):
+    return zlib.crc32(slug.encode('utf-8'))
+
+
+def transaction(*, readonly, signal=None):
+    # signal is fired after commit, so that a woken up reader
+    # is guaranteed to see the changes
+
+    def wrapper(meth):
+        timer = metrics.TRANSACTION_SECONDS.time
+
+        @functools.wraps(meth)
+        def wrapped(self, *args, **kwargs):
+            # formatting arguments and results is expensive
+            debug = self.logger.isEnabledFor(logging.DEBUG)
+            with self._connection(readonly=readonly) as conn, \
+                    timer(meth.__name__):
+                cursor = conn.cursor()
+                if debug:
+                    self.logger.debug("trying to %s(*%r, **%r)",
+                                      meth.__name__, args, kwargs)
+                cursor.execute(self.BEGIN_READONLY if readonly
+                               else self.BEGIN_WRITE)
+                try:
+                    result = meth(self, cursor, *args, **kwargs)
+                except Exception as exc:
+                    self.logger.info("%s() failed with: %s",
+                                     meth.__name__, exc)
+                    cursor.execute("ROLLBACK")
+                    raise
+                else:
+                    if debug:
+                        self.logger.debug("%s(*%r, **%r) -> %r",
+                                          meth.__name__, args, kwargs,
+                                          result)
+                    cursor.execute("COMMIT")
+            if signal and self.events:
+                getattr(self.events, signal).notify()
+            return result
+        return wrapped
+    return wrapper
+
+
+class SbFeedStorage:
+    # Queries shared by all storage backends. A backend provides
+    # _connection(readonly), create_db(), upgrade_db(), vacuum(), close() and
+    # check_notifications_needed(), and may override any query that
+    # its database can do better.
+
+    BEGIN_READONLY = "BEGIN"
+    BEGIN_WRITE = "BEGIN"
+    GET_ITEMS_CHUNK = 500
+
+    def __init__(self, schedule=None, events=None):
+        self.events = events
+        self.schedule = schedule or SbFeedSchedule()
+        self.logger = logging.getLogger("sbfeed.model")
+
+    @transaction(readonly=True)
+    def check_feed_is_known(self, cursor, feed):
+        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
+        return bool(cursor.fetchone())
+
+    @transaction(readonly=False, signal='feeds_changed')
+    def init_feed(self, cursor, feed):
+        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
+        if cursor.fetchone():
+            raise exceptions.AlreadyExistsError()
+        cursor.execute(
+            "INSERT INTO feed "
+            "(slug, last_modified, last_tried_to_fetch, created, shard_key) "
+            "VALUES (?, NULL, NULL, ?, ?)",
+            [feed, int(time.time()), shard_key(feed)]
+        )
+
+    def _bump_last_pubdate(self, cursor, feed, pubdate):
+        cursor.execute(
+            "UPDATE feed SET last_pubdate = ? "
+            "WHERE slug = ? AND (last_pubdate IS NULL OR last_pubdate < ?)",
+            [pubdate, feed, pubdate]
+        )
+
+    @transaction(readonly=False, signal='items_stored')
+    def store_items(self, cursor, feed, items):
+        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
+        if not cursor.fetchone():
+            raise exceptions.NotExistError()
+        cursor.executemany(
+            "INSERT INTO feed_item (feed, title, link, text, pubdate) "
+            "VALUES (?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            [(feed, item['title'], item['link'], item['text'],
+              item['pubdate'])
+             for item in items]
+        )
+        stored = cursor.rowcount
+        if items:
+            self._bump_last_pubdate(cursor, feed,
+                                    max(item['pubdate'] for item in items))
+        return stored
+
+    @transaction(readonly=False, signal='feeds_changed')
+    def mark_feed_as_processed(self, cursor, feed, *, last_modified,
+                               etag=None, expires=None, changed=False):
+        now = time.time()
+        cursor.execute(
+            "SELECT fetch_interval, fetch_errors, "
+            "(SELECT count(*) FROM subscription WHERE feed = slug) "
+            "FROM feed WHERE slug = ?",
+            [feed]
+        )
+        row = cursor.fetchone()
+        if not row:
+            raise exceptions.NotExistError()
+        interval, errors, subscribers = row
+        if last_modified is None:
+            errors += 1
+            cursor.execute(
+                "UPDATE feed SET last_tried_to_fetch = ?, fetch_errors = ?, "
+                "next_fetch = ? "
+                "WHERE slug = ?",
+                [now, errors, now + self.schedule.retry_interval(errors), feed]
+            )
+        else:
+            interval = self.schedule.next_interval(interval, changed,
+                                                   subscribers)
+            cursor.execute(
+                "UPDATE feed SET last_modified = ?, last_tried_to_fetch = ?, "
+                "etag = ?, expires = ?, fetch_interval = ?, "
+                "fetch_errors = 0, next_fetch = ? "
+                "WHERE slug = ? ",
+                [last_modified, now, etag, expires, interval,
+                 max(now + interval, expires or 0), feed]
+            )
+
+    @transaction(readonly=False)
+    def subscribe(self, cursor, chat_id, feed):
+        cursor.execute("SELECT 1 FROM feed WHERE slug = ?", [feed])
+        if not cursor.fetchone():
+            raise exceptions.NotExistError()
+        cursor.execute(
+            "INSERT INTO subscription (chat_id, feed, last_notified) "
+            "VALUES (?, ?, ?) ON CONFLICT DO NOTHING",
+            [chat_id, feed, int(time.time())]
+        )
+        if not cursor.rowcount:
+            raise exceptions.AlreadyExistsError()
+
+    @transaction(readonly=True)
+    def list_subscriptions(self, cursor, chat_id):
+        cursor.execute("SELECT feed FROM subscription WHERE "
+                       "chat_id = ? ORDER BY feed", [chat_id])
+        return [row[0] for row in cursor.fetchall()]
+
+    @transaction(readonly=False)
+    def unsubscribe(self, cursor, chat_id, feed):
+        cursor.execute("DELETE FROM subscription WHERE "
+                       "chat_id = ? AND feed = ?", [chat_id, feed])
+        if not cursor.rowcount:
+            raise exceptions.NotExistError()
+
+    @transaction(readonly=False)
+    def unsubscribe_all(self, cursor, chat_id):
+        cursor.execute("DELETE FROM subscription WHERE "
+                       "chat_id = ?", [chat_id])
+        if not cursor.rowcount:
+            raise exceptions.NotExistError()
+
+    def _shard_filter(self, column, shards, params):
+        # shards is a (number of shards, shards to pick) pair or None
+        if shards is None:
+            return ""
+        total, owned = shards
+        if not owned:
+            # "IN ()" only works in sqlite
+            return "AND 0 = 1"
+        params.append(total)
+        params.extend(sorted(owned))
+        return "AND %s %% ? IN (%s)" % (column, ", ".join("?" * len(owned)))
+
+    @transaction(readonly=True)
+    def get_fetches_needed(self, cursor, shards=None):
+        params = [time.time()]
+        shard_filter = self._shard_filter("shard_key", shards, params)
+        cursor.execute(
+            "SELECT slug, last_modified, last_tried_to_fetch, etag "
+            "FROM feed "
+            "WHERE next_fetch <= ? %s "
+            "ORDER BY next_fetch" % (shard_filter, ),
+            params
+        )
+        return cursor.fetchall()
+
+    @transaction(readonly=True)
+    def get_next_fetch_time(self, cursor, shards=None, exclude=()):
+        params = []
+        shard_filter = self._shard_filter("shard_key", shards, params)
+        # excluded feeds are being fetched, they are still due until then
+        exclude_filter = ""
+        if exclude:
+            params.extend(sorted(exclude))
+            exclude_filter = "AND slug NOT IN (%s)" % (
+                ", ".join("?" * len(exclude)), )
+        cursor.execute("SELECT min(next_fetch) FROM feed "
+                       "WHERE next_fetch IS NOT NULL %s %s"
+                       % (shard_filter, exclude_filter), params)
+        return cursor.fetchone()[0]
+
+    @transaction(readonly=True)
+    def count_due_subscriptions(self, cursor):
+        cursor.execute(
+            "SELECT count(*) FROM feed AS f "
+            "JOIN subscription AS su "
+            "ON (su.feed = f.slug AND su.last_notified < f.last_pubdate)"
+        )
+        return cursor.fetchone()[0]
+
+    @transaction(readonly=True)
+    def get_items(self, cursor, keys):
+        # keys are (feed, pubdate) pairs
+        by_feed = {}
+        for feed, pubdate in keys:
+            by_feed.setdefault(feed, []).append(pubdate)
+        items = {}
+        for feed, pubdates in by_feed.items():
+            for start in range(0, len(pubdates), self.GET_ITEMS_CHUNK):
+                chunk = pubdates[start:start + self.GET_ITEMS_CHUNK]
+                cursor.execute(
+                    "SELECT title, link, text, pubdate FROM feed_item "
+                    "WHERE feed = ? AND pubdate IN (%s)"
+                    % (", ".join("?" * len(chunk)), ),
+                    [feed] + chunk
+                )
+                for title, link, text, pubdate in cursor.fetchall():
+                    items[feed, pubdate] = {'item_title': title,
+                                            'item_link': link,
+                                            'item_text': text,
+                                            'item_pub_date': pubdate}
+        return items
+
+    def _advance_subscriptions(self, cursor, notifications):
+        cursor.executemany(
+            "UPDATE subscription SET last_notified = ? "
+            "WHERE feed = ? AND chat_id = ? AND last_notified < ?",
+            [(item_pub_date, feed, chat_id, item_pub_date)
+             for chat_id, feed, item_pub_date in notifications]
+        )
+        return cursor.rowcount
+
+    @transaction(readonly=False)
+    def enqueue_notifications(self, cursor, messages, notifications):
+        # hands pending items over to the outbox: subscriptions move past
+        # them in the same transaction, so that nothing is lost or queued
+        # twice; a message is a (chat_id, feed, item pubdates) tuple
+        cursor.executemany(
+            "INSERT INTO outbox "
+            "(key, chat_id, feed, first_pubdate, items, created) "
+            "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT DO NOTHING",
+            [('%d:%s:%d' % (chat_id, feed, pubdates[0]), chat_id, feed,
+              pubdates[0], ','.join(map(str, pubdates)), int(time.time()))
+             for chat_id, feed, pubdates in messages]
+        )
+        enqueued = cursor.rowcount
+        self._advance_subscriptions(cursor, notifications)
+        return enqueued
+
+    @transaction(readonly=False)
+    def claim_outbox(self, cursor, owner, limit, lease, shards=None):
+        # messages of a chat are not handed out while an earlier one
+        # waits for a retry, to keep them in order
+        now = time.time()
+        params = [now, now, now]
+        shard_filter = self._shard_filter("abs(chat_id)", shards, params)
+        params.append(limit)
+        cursor.execute(
+            "SELECT id, chat_id, feed, items, attempts FROM outbox "
+            "WHERE state = 'pending' AND next_attempt <= ? "
+            "AND claimed_until <= ? "
+            "AND chat_id NOT IN ("
+            "    SELECT chat_id FROM outbox "
+            "    WHERE state = 'pending' AND next_attempt > ?"
+            ") %s "
+            "ORDER BY id LIMIT ?" % (shard_filter, ),
+            params
+        )
+        rows = cursor.fetchall()
+        cursor.executemany(
+            "UPDATE outbox SET claimed_by = ?, claimed_until = ? "
+            "WHERE id = ?",
+            [(owner, now + lease, row[0]) for row in rows]
+        )
+        return [self._outbox_message(row) for row in rows]
+
+    def _outbox_message(self, row):
+        return {'id': row[0],
+                'chat_id': row[1],
+                'feed': row[2],
+                'pubdates': [int(pubdate) for pubdate in row[3].split(',')],
+                'attempts': row[4]}
+
+    @transaction(readonly=False)
+    def finish_outbox(self, cursor, owner, updates):
+        # updates are (id, state, attempts, next_attempt, error) tuples;
+        # rows whose lease ran out and went to another owner are left alone
+        cursor.executemany(
+            "UPDATE outbox SET state = ?, attempts = ?, next_attempt = ?, "
+            "last_error = ?, claimed_by = NULL, claimed_until = 0 "
+            "WHERE id = ? AND claimed_by = ?",
+            [(state, attempts, next_attempt, error, outbox_id, owner)
+             for outbox_id, state, attempts, next_attempt, error in updates]
+        )
+        return cursor.rowcount
+
+    @transaction(readonly=False)
+    def forget_chat(self, cursor, chat_id):
+        # for chats that blocked the bot or are gone
+        cursor.execute("DELETE FROM outbox WHERE "
+                       "chat_id = ? AND state = 'pending'", [chat_id])
+        cursor.execute("DELETE FROM subscription WHERE "
+                       "chat_id = ?", [chat_id])
+        return cursor.rowcount
+
+    @transaction(readonly=False)
+    def prune_outbox(self, cursor, min_age):
+        cursor.execute("DELETE FROM outbox "
+                       "WHERE state IN ('sent', 'failed') AND created < ?",
+                       [int(time.time()) - min_age])
+        return cursor.rowcount
+
+    @transaction(readonly=False)
+    def prune_items(self, cursor, min_age):
+        # an item can go once it is min_age old, every subscriber of its
+        # feed was notified about it and no queued message needs it;
+        # items of feeds with no subscribers only wait for min_age
+        cursor.execute(
+            "SELECT f.slug, min(su.last_notified), ("
+            "    SELECT min(first_pubdate) - 1 FROM outbox "
+            "    WHERE feed = f.slug AND state = 'pending'"
+            ") "
+            "FROM feed AS f "
+            "LEFT JOIN subscription AS su ON (su.feed = f.slug) "
+            "GROUP BY f.slug"
+        )
+        keep_after = int(time.time()) - min_age
+        cursor.executemany(
+            "DELETE FROM feed_item WHERE feed = ? AND pubdate <= ?",
+            [(feed, min(limit for limit in (notified, queued, keep_after)
+                        if limit is not None))
+             for feed, notified, queued in cursor.fetchall()]
+        )
+        return cursor.rowcount
+
+    @transaction(readonly=False)
+    def collect_orphan_feeds(self, cursor, min_age):
+        # a feed is created just before its first subscription,
+        # so give it some time to get one
+        cursor.execute(
+            "DELETE FROM feed "
+            "WHERE (created IS NULL OR created < ?) "
+            "AND NOT EXISTS (SELECT 1 FROM subscription WHERE feed = slug)",
+            [int(time.time()) - min_age]
+        )
+        return cursor.rowcount
+
+    def _take_lease(self, cursor, kind, shard, owner, now, expires):
+        cursor.execute(
+            "INSERT INTO shard_lease (kind, shard, owner, expires) "
+            "VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (kind, shard) DO UPDATE "
+            "SET owner = excluded.owner, expires = excluded.expires "
+            "WHERE shard_lease.owner = excluded.owner "
+            "OR shard_lease.expires <= ?",
+            [kind, shard, owner, expires, now]
+        )
+        return bool(cursor.rowcount)
+
+    @transaction(readonly=False)
+    def renew_leases(self, cursor, owner, index, kinds, total, ttl):
+        now = int(time.time())
+        expires = now + ttl
+        owned = {kind: frozenset() for kind in kinds}
+        # worker slot is held until the previous holder's lease expires,
+        # so a restarted worker can't run alongside a stuck one
+        if not self._take_lease(cursor, 'worker', index, owner, now,
+                                expires):
+            return owned
+        cursor.execute("SELECT count(*) FROM shard_lease "
+                       "WHERE kind = 'worker' AND expires > ?", [now])
+        workers = cursor.fetchone()[0]
+        fair_share = -(-total // workers)
+        for kind in kinds:
+            cursor.execute("UPDATE shard_lease SET expires = ? "
+                           "WHERE kind = ? AND owner = ?",
+                           [expires, kind, owner])
+            cursor.execute("SELECT shard FROM shard_lease "
+                           "WHERE kind = ? AND owner = ? ORDER BY shard",
+                           [kind, owner])
+            shards = [row[0] for row in cursor.fetchall()]
+            # shards above the fair share are given away to newcomers
+            cursor.executemany("DELETE FROM shard_lease "
+                               "WHERE kind = ? AND shard = ? AND owner = ?",
+                               [(kind, shard, owner)
+                                for shard in shards[fair_share:]])
+            shards = shards[:fair_share]
+            for shard in range(total):
+                if len(shards) >= fair_share:
+                    break
+                if shard not in shards and self._take_lease(
+                        cursor, kind, shard, owner, now, expires):
+                    shards.append(shard)
+            owned[kind] = frozenset(shards)
+        return owned
+
+    @transaction(readonly=False)
+    def release_leases(self, cursor, owner):
+        cursor.execute("DELETE FROM shard_lease WHERE owner = ?", [owner])
@@ -0,0 +1,111 @@
+import json
+import queue
+import logging
+import threading
+from urllib.parse import urlsplit
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+from sbfeed_bot import metrics
+
+
+class WebhookHandler(BaseHTTPRequestHandler):
+    def _reply(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        webhook = self.server.webhook
+        if self.path != webhook.url_path:
+            self._reply(404)
+            return
+        try:
+            body = self.rfile.read(int(self.headers.get('Content-Length')))
+            update = Update.de_json(json.loads(body.decode('utf-8')),
+                                    webhook.dispatcher.bot)
+            if update is None:
+                raise ValueError('empty update')
+        except Exception:
+            webhook.logger.warning('got a malformed update', exc_info=True)
+            metrics.UPDATES.inc('malformed')
+            self._reply(400)
+            return
+        try:
+            webhook.updates.put_nowait(update)
+        except queue.Full:
+            # telegram retries updates it failed to deliver
+            webhook.logger.warning('update queue is full, dropping %d',
+                                   update.update_id)
+            metrics.UPDATES.inc('dropped')
+            self._reply(503, [('Retry-After', '1')])
+            return
+        metrics.UPDATES.inc('queued')
+        self._reply(200)
+
+    def log_message(self, format, *args):
+        self.server.webhook.logger.debug(format, *args)
+
+
+class SbFeedWebhook:
+    # Receives updates pushed by telegram and hands them to the dispatcher,
+    # instead of long polling for them. TLS is expected to be terminated
+    # by a reverse proxy in front of the listener.
+
+    def __init__(self, dispatcher, url, listen='127.0.0.1', port=8443,
+                 workers=4, queue_size=256):
+        self.logger = logging.getLogger('sbfeed.webhook')
+        self.dispatcher = dispatcher
+        self.url = url
+        # the path should carry a secret, so that nobody else can post
+        self.url_path = urlsplit(url).path or '/'
+        self.listen = listen
+        self.port = port
+        self.updates = queue.Queue(maxsize=queue_size)
+        self.workers = [
+            threading.Thread(name='webhook-%d' % (index, ),
+                             target=self._process_updates, daemon=True)
+            for index in range(workers)
+        ]
+        self.server = None
+
+    def start(self):
+        self.server = ThreadingHTTPServer((self.listen, self.port),
+                                          WebhookHandler)
+        self.server.daemon_threads = True
+        self.server.webhook = self
+        for worker in self.workers:
+            worker.start()
+        threading.Thread(name='webhook', target=self.server.serve_forever,
+                         daemon=True).start()
+        self.logger.info('listening for updates on http://%s:%d%s',
+                         self.listen, self.server.server_address[1],
+                         self.url_path)
+        self.dispatcher.bot.setWebhook(webhook_url=self.url)
+        self.logger.info('webhook set to %s', self.url)
+
+    def _process_updates(self):
+        while True:
+            update = self.updates.get()
+            if update is None:
+                return
+            try:
+                self.dispatcher.process_update(update)
+            except Exception:
+                self.logger.exception('failed to process update %r', update)
+
+    def stop(self):
+        # the webhook stays set, telegram keeps updates until it is back
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        # queued updates go first; with a full queue the workers are left
+        # to die with the process, as daemon threads, instead of hanging
+        for worker in self.workers:
+            try:
+                self.updates.put_nowait(None)
+            except queue.Full:
+                break
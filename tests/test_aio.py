@@ -0,0 +1,158 @@
+import asyncio
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from sbfeed_bot.aio import SbFeedAsyncRuntime
+from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot.events import SbFeedEvents
+from sbfeed_bot.notifier import SbFeedNotifier
+
+
+class FakeModel:
+    def __init__(self, feeds):
+        self.due = set(feeds)
+        self.items = []
+        self.outbox = []
+        self.finished = []
+        self.lock = threading.Lock()
+
+    def get_fetches_needed(self, shards=None):
+        with self.lock:
+            return [(feed, None, None, None) for feed in sorted(self.due)]
+
+    def get_next_fetch_time(self, shards=None, exclude=()):
+        return None
+
+    def check_notifications_needed(self, limit, after=None, shards=None):
+        items, self.items = self.items[:limit], self.items[limit:]
+        return items
+
+    def get_items(self, keys):
+        return dict(((feed, pubdate),
+                     {'item_title': 'gig %d' % (pubdate, ),
+                      'item_link': 'http://sb/', 'item_text': 'text',
+                      'item_pub_date': pubdate})
+                    for feed, pubdate in keys)
+
+    def enqueue_notifications(self, messages, notifications):
+        self.outbox.extend(messages)
+        return len(messages)
+
+    def claim_outbox(self, owner, limit, lease, shards=None):
+        messages, self.outbox = self.outbox[:limit], self.outbox[limit:]
+        return [{'id': pubdates[0] * 10 + chat_id, 'chat_id': chat_id,
+                 'feed': feed, 'pubdates': pubdates, 'attempts': 0}
+                for chat_id, feed, pubdates in messages]
+
+    def finish_outbox(self, owner, updates):
+        self.finished.extend(updates)
+        return len(updates)
+
+
+class FakeFetcher:
+    per_host = 1
+
+    def __init__(self, model, events):
+        self.model = model
+        self.events = events
+        self.processed = []
+        self.running = 0
+        self.max_running = 0
+        self.lock = threading.Lock()
+
+    def host(self, slug):
+        return slug.split('/')[0]
+
+    def shards(self):
+        return None
+
+    def next_fetch_time(self, in_flight=None):
+        return self.model.get_next_fetch_time(exclude=in_flight or ())
+
+    def process_feed(self, slug, last_modified, last_tried_to_fetch, etag):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+            self.processed.append(slug)
+            self.model.due.discard(slug)
+        self.events.feeds_changed.notify()
+
+
+class FakeBot(SbFeedBot):
+    # renders like the real bot, sends nowhere
+    def __init__(self):
+        self.sent = []
+
+    def send_text(self, chat_id, text):
+        self.sent.append((chat_id, text.split('\n')[0]))
+
+
+class AsyncRuntimeTest(unittest.TestCase):
+    def make_runtime(self, feeds=()):
+        self.events = SbFeedEvents()
+        self.model = FakeModel(feeds)
+        self.fetcher = FakeFetcher(self.model, self.events)
+        self.bot = FakeBot()
+        self.notifier = SbFeedNotifier(self.model, self.bot, concurrency=1,
+                                       rate=1000, batch_size=10)
+        self.addCleanup(self.notifier.shutdown)
+        return SbFeedAsyncRuntime(self.fetcher, self.notifier, self.bot,
+                                  self.events, workers=4, cleanup=None,
+                                  cleanup_interval=3600)
+
+    def run_until(self, runtime, coro, done, timeout=5):
+        # runs one loop of the runtime until done() or the timeout
+        async def main():
+            runtime.loop = asyncio.get_running_loop()
+            runtime.executor = ThreadPoolExecutor(max_workers=4)
+            runtime.loop.set_default_executor(runtime.executor)
+            task = runtime.loop.create_task(coro)
+            deadline = time.monotonic() + timeout
+            while not done() and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            runtime.executor.shutdown(wait=True)
+        asyncio.run(main())
+        self.assertTrue(done())
+
+    def test_fetch_loop(self):
+        feeds = ['sb/a', 'sb/b', 'other/c']
+        runtime = self.make_runtime(feeds)
+        self.run_until(runtime, runtime._fetch_loop(),
+                       lambda: len(self.fetcher.processed) == 3)
+        self.assertEqual(sorted(self.fetcher.processed), sorted(feeds))
+        # one request per host at a time
+        self.assertEqual(self.fetcher.max_running, 2)
+
+    def test_notify_loop_wakes_on_items_stored(self):
+        runtime = self.make_runtime()
+        items = [{'chat_id': chat_id, 'feed': 'gig',
+                  'item_title': 'gig %d' % (pubdate, ),
+                  'item_link': 'http://sb/', 'item_text': 'text',
+                  'item_pub_date': pubdate}
+                 for pubdate in (1, 2) for chat_id in (1, 2)]
+
+        def store():
+            self.model.items = items
+            self.events.items_stored.notify()
+
+        # the loop is idle for idle_wait unless woken up
+        threading.Timer(0.1, store).start()
+        self.run_until(runtime, runtime._notify_loop(),
+                       lambda: len(self.model.finished) == 4, timeout=2)
+        for chat_id in (1, 2):
+            self.assertEqual([title for chat, title in self.bot.sent
+                              if chat == chat_id], ['gig 1', 'gig 2'])
+        self.assertEqual(sorted((outbox_id, state) for outbox_id, state, *_
+                                in self.model.finished),
+                         [(11, 'sent'), (12, 'sent'), (21, 'sent'),
+                          (22, 'sent')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from sbfeed_bot import bench
+from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot.feed import SbFeedFeeder
+from sbfeed_bot.model import SbFeedModel
+
+
+class FakesTest(unittest.TestCase):
+    def setUp(self):
+        self.server = bench.FakesServer(('127.0.0.1', 0), bench.FakesHandler)
+        self.server.songbook = bench.FakeSongbook()
+        self.server.telegram = bench.FakeTelegram()
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % (self.server.server_address[1], )
+        bench.control(self.url, '/reset?feeds=1')
+
+    def test_songbook_is_fetched(self):
+        feeder = SbFeedFeeder(self.url, timeout=5)
+        self.addCleanup(feeder.pool.close)
+        for _ in range(3):
+            self.server.songbook.add_comment(self.url)
+        result = feeder.fetch('gig-0', not_before=None)
+        links = [item['link'] for item in result.items]
+        self.assertEqual(len(links), 3)
+        self.assertTrue(all(bench.CREATED_RE.search(link) for link in links))
+        # unchanged gigs are revalidated instead of downloaded again
+        again = feeder.fetch('gig-0', not_before=None, etag=result.etag)
+        self.assertEqual(again.items, [])
+
+    def test_deliveries_are_measured(self):
+        bot = SbFeedBot(bench.TOKEN, None, None, base_url=self.url + '/bot')
+        created = time.time() - 2
+        bot.send_text(1, 'comment\n\n%s/gig/gig-0/?created=%.6f'
+                         % (self.url, created))
+        bot.send_text(1, 'no link')
+        stats = self.server.telegram.stats()
+        self.assertEqual(stats['messages'], 2)
+        [latency] = stats['latencies']
+        self.assertGreaterEqual(latency, 2)
+
+    def test_populate(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        model = SbFeedModel(os.path.join(tmpdir.name, 'sbfeed.db'))
+        self.addCleanup(model.close)
+        model.create_db()
+        bench.populate(model, feeds=2, subscriptions=5)
+        self.assertEqual(model.list_subscriptions(1), ['gig-1'])
+        self.assertEqual(model.list_subscriptions(4), ['gig-0'])
+        self.assertEqual(len(model.get_fetches_needed()), 2)
+
+
+class PercentileTest(unittest.TestCase):
+    def test_percentile(self):
+        values = list(range(100, 0, -1))
+        self.assertEqual(bench.percentile(values, 0.5), 51)
+        self.assertEqual(bench.percentile(values, 0.99), 100)
+        self.assertEqual(bench.percentile([3], 0.99), 3)
+        self.assertNotEqual(bench.percentile([], 0.5),
+                            bench.percentile([], 0.5))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,193 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import Future
+from types import SimpleNamespace
+
+from telegram.error import NetworkError
+
+from sbfeed_bot import exceptions
+from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot.model import SbFeedModel
+
+
+class FakeTelegram:
+    def __init__(self):
+        self.sent = []
+        # replies that fail to go out
+        self.failing = set()
+        self.lock = threading.Lock()
+
+    def sendMessage(self, chat_id, text):
+        if text in self.failing:
+            raise NetworkError('connection reset')
+        with self.lock:
+            self.sent.append((chat_id, text))
+
+
+class InlineExecutor:
+    # runs probes right away, so they are done before anyone waits
+    def submit(self, fn, *args):
+        future = Future()
+        try:
+            future.set_result(fn(*args))
+        except Exception as exc:
+            future.set_exception(exc)
+        return future
+
+    def shutdown(self, wait=True):
+        pass
+
+
+class FakeFeeder:
+    def __init__(self):
+        self.fetched = []
+        self.missing = set()
+        self.errors = {}
+        self.release = threading.Event()
+        self.release.set()
+
+    def fetch(self, feed, not_before, etag=None):
+        self.fetched.append(feed)
+        self.release.wait(5)
+        if feed in self.missing:
+            raise exceptions.NotExistError()
+        if feed in self.errors:
+            raise self.errors[feed]
+
+
+class BotTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.model = SbFeedModel(os.path.join(tmpdir.name, 'sbfeed.db'))
+        self.addCleanup(self.model.close)
+        self.model.create_db()
+        self.feeder = FakeFeeder()
+        self.bot = SbFeedBot('123:token', self.model, self.feeder)
+        self.addCleanup(self.bot.probe_executor.shutdown)
+        self.telegram = FakeTelegram()
+
+    def command(self, handler, chat_id, *args):
+        update = SimpleNamespace(message=SimpleNamespace(chat_id=chat_id))
+        handler(self.telegram, update, *args)
+
+    def subscribe(self, chat_id, *args):
+        self.command(self.bot._handle_subscribe, chat_id, list(args))
+
+    def wait_probes(self):
+        # done callbacks run before the probe thread goes idle
+        self.bot.probe_executor.shutdown(wait=True)
+
+    def wait_replies(self, chat_id, count):
+        deadline = time.monotonic() + 5
+        while len(self.replies(chat_id)) < count:
+            self.assertLess(time.monotonic(), deadline)
+            time.sleep(0.01)
+
+    def replies(self, chat_id):
+        return [text for chat, text in self.telegram.sent if chat == chat_id]
+
+
+class SubscribeTest(BotTestCase):
+    def test_probes_are_coalesced(self):
+        self.feeder.release.clear()
+        self.subscribe(1, 'gig')
+        self.subscribe(2, 'gig')
+        self.feeder.release.set()
+        self.wait_probes()
+        self.assertEqual(self.feeder.fetched, ['gig'])
+        for chat_id in (1, 2):
+            self.assertEqual(self.replies(chat_id), [
+                'checking gig, hold on',
+                'congratulations! you subscribed to gig',
+            ])
+            self.assertEqual(self.model.list_subscriptions(chat_id), ['gig'])
+
+    def test_missing_feed_is_remembered(self):
+        self.feeder.missing.add('gig')
+        self.subscribe(1, 'gig')
+        self.wait_probes()
+        self.subscribe(2, 'gig')
+        self.assertEqual(self.feeder.fetched, ['gig'])
+        self.assertEqual(self.replies(1)[-1],
+                         'failed to fetch gig, does it exist?')
+        self.assertEqual(self.replies(2),
+                         ['failed to fetch gig, does it exist?'])
+        self.assertFalse(self.model.check_feed_is_known('gig'))
+
+    def test_missing_feed_expires(self):
+        self.feeder.missing.add('gig')
+        self.bot.MISSING_FEED_TTL = 0
+        for attempt in range(2):
+            self.subscribe(1, 'gig')
+            self.wait_replies(1, 2 * (attempt + 1))
+        self.assertEqual(self.feeder.fetched, ['gig', 'gig'])
+
+    def test_known_feed_is_not_fetched(self):
+        self.model.init_feed('gig')
+        self.subscribe(1, 'gig')
+        self.subscribe(1, 'gig')
+        self.assertEqual(self.feeder.fetched, [])
+        self.assertEqual(self.replies(1), [
+            'congratulations! you subscribed to gig',
+            'you are already subscribed to gig',
+        ])
+
+    def test_feed_collected_meanwhile(self):
+        # the janitor deletes the feed between the lookup and subscribe
+        self.model.check_feed_is_known = lambda slug: True
+        self.feeder.release.clear()
+        self.subscribe(1, 'gig')
+        self.feeder.release.set()
+        self.wait_probes()
+        self.assertEqual(self.feeder.fetched, ['gig'])
+        self.assertEqual(self.replies(1), [
+            'checking gig, hold on',
+            'congratulations! you subscribed to gig',
+        ])
+
+    def test_feed_collected_after_probe(self):
+        self.model.init_feed = lambda slug: None
+        self.feeder.release.clear()
+        self.subscribe(1, 'gig')
+        self.feeder.release.set()
+        self.wait_probes()
+        self.assertEqual(self.replies(1), [
+            'checking gig, hold on',
+            'failed to fetch gig, does it exist?',
+        ])
+
+    def test_probe_done_at_once(self):
+        self.bot.probe_executor = InlineExecutor()
+        self.subscribe(1, 'gig')
+        self.assertEqual(self.replies(1), [
+            'checking gig, hold on',
+            'congratulations! you subscribed to gig',
+        ])
+        self.assertEqual(self.bot.probes, {})
+
+    def test_failed_reply_is_logged(self):
+        self.feeder.missing.add('gone')
+        self.feeder.errors['broken'] = OSError('timed out')
+        self.telegram.failing.update(['failed to fetch gig, does it exist?',
+                                      'failed to fetch gig: timed out'])
+        with self.assertLogs('sbfeed.bot', 'ERROR') as logs:
+            self.subscribe(1, 'gone')
+            self.subscribe(1, 'broken')
+            self.wait_probes()
+        for slug in ('gone', 'broken'):
+            self.assertTrue(any('failed to subscribe 1 to %r' % (slug, )
+                                in line for line in logs.output))
+
+    def test_syntax(self):
+        self.subscribe(1, 'no/such')
+        self.subscribe(1)
+        self.assertEqual(self.replies(1),
+                         ['broken slug', 'syntax: /subscribe <slug>'])
+
+
+if __name__ == '__main__':
+    unittest.main()
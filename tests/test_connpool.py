@@ -0,0 +1,85 @@
+import threading
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sbfeed_bot.connpool import HttpConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        body = self.path.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        # drops the connection without telling the client, like a server
+        # whose keep-alive timeout ran out
+        self.close_connection = self.path.startswith('/drop')
+
+    def log_message(self, format, *args):
+        pass
+
+
+class HttpConnectionPoolTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.connections = 0
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.url = 'http://127.0.0.1:%d' % (self.server.server_address[1], )
+
+    def get(self, pool, path):
+        with pool.request('GET', self.url + path, {}) as response:
+            return response.read()
+
+    def make_pool(self, **kwargs):
+        pool = HttpConnectionPool(**dict({'size': 2, 'idle_timeout': 60,
+                                          'timeout': 5}, **kwargs))
+        self.addCleanup(pool.close)
+        return pool
+
+    def test_connection_is_reused(self):
+        pool = self.make_pool()
+        for index in range(3):
+            self.assertEqual(self.get(pool, '/feed/%d' % (index, )),
+                             b'/feed/%d' % (index, ))
+        self.assertEqual(self.server.connections, 1)
+        stats = pool.stats()
+        self.assertEqual((stats['requests'], stats['connections'],
+                          stats['reused'], stats['idle']), (3, 1, 2, 1))
+
+    def test_idle_connections_expire(self):
+        pool = self.make_pool(idle_timeout=0)
+        self.get(pool, '/a')
+        self.get(pool, '/b')
+        self.assertEqual(self.server.connections, 2)
+        self.assertEqual(pool.stats()['expired'], 1)
+
+    def test_stale_connection_is_replaced(self):
+        pool = self.make_pool()
+        self.get(pool, '/drop')
+        self.assertEqual(self.get(pool, '/b'), b'/b')
+        self.assertEqual(pool.stats()['stale'], 1)
+        self.assertEqual(self.server.connections, 2)
+
+    def test_unread_response_is_not_reused(self):
+        pool = self.make_pool()
+        with pool.request('GET', self.url + '/a', {}):
+            pass
+        self.get(pool, '/b')
+        self.assertEqual(pool.stats()['connections'], 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
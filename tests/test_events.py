@@ -0,0 +1,30 @@
+import threading
+import time
+import unittest
+
+from sbfeed_bot.events import Signal
+
+
+class SignalTest(unittest.TestCase):
+    def test_wait_times_out(self):
+        started = time.monotonic()
+        self.assertFalse(Signal().wait(0.05))
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+
+    def test_notifications_coalesce(self):
+        signal = Signal()
+        signal.notify()
+        signal.notify()
+        self.assertTrue(signal.wait(0))
+        self.assertFalse(signal.wait(0))
+
+    def test_waiter_is_woken(self):
+        signal = Signal()
+        threading.Timer(0.05, signal.notify).start()
+        started = time.monotonic()
+        self.assertTrue(signal.wait(5))
+        self.assertLess(time.monotonic() - started, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,162 @@
+import threading
+import time
+import unittest
+from email.utils import formatdate
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from sbfeed_bot import metrics
+from sbfeed_bot.feed import SbFeedFeeder
+
+
+def rss(build_date, pubdates):
+    items = ''.join(
+        '<item><title>comment %d</title><link>http://sb/%d</link>'
+        '<description>&lt;pre&gt;text %d&lt;/pre&gt;</description>'
+        '<pubDate>%s</pubDate></item>' % (pubdate, pubdate, pubdate,
+                                          formatdate(pubdate))
+        for pubdate in sorted(pubdates, reverse=True)
+    )
+    return ('<?xml version="1.0"?><rss><channel>'
+            '<lastBuildDate>%s</lastBuildDate>%s</channel></rss>'
+            % (formatdate(build_date), items)).encode('utf-8')
+
+
+class SongbookHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        etag = self.headers.get('If-None-Match')
+        if etag is not None and etag == server.etag:
+            self.send_response(304)
+            body = b''
+        else:
+            self.send_response(200)
+            body = server.body
+        self.send_header('ETag', server.etag)
+        for header in server.extra_headers.items():
+            self.send_header(*header)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class SongbookTestCase(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), SongbookHandler)
+        self.server.daemon_threads = True
+        self.server.requests = []
+        self.server.etag = '"v1"'
+        self.server.extra_headers = {}
+        self.server.body = rss(3000, [1000, 2000, 3000])
+        threading.Thread(target=self.server.serve_forever,
+                         daemon=True).start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+        self.feeder = SbFeedFeeder(
+            'http://127.0.0.1:%d' % (self.server.server_address[1], ),
+            timeout=5
+        )
+        self.addCleanup(self.feeder.pool.close)
+
+
+class FeederTest(SongbookTestCase):
+    def test_fetch_items_after_not_before(self):
+        result = self.feeder.fetch('feed', 1000)
+        self.assertEqual(result.last_modified, 3000)
+        self.assertEqual([item['pubdate'] for item in result.items],
+                         [2000, 3000])
+        self.assertEqual(result.items[0]['text'], 'text 2000')
+        self.assertEqual(result.etag, '"v1"')
+
+    def test_etag_is_revalidated(self):
+        result = self.feeder.fetch('feed', 1000, etag='"v1"')
+        self.assertEqual(self.server.requests[-1]['If-None-Match'], '"v1"')
+        self.assertEqual(result.items, [])
+        self.assertEqual(result.last_modified, 1000)
+        self.assertEqual(result.etag, '"v1"')
+
+    def test_parsing_stops_at_seen_items(self):
+        self.server.body = rss(200, range(1, 201))
+        parsed = []
+        parse_item = self.feeder._parse_item
+
+        def counting_parse_item(item):
+            parsed.append(item)
+            return parse_item(item)
+
+        self.feeder._parse_item = counting_parse_item
+        result = self.feeder.fetch('feed', 198)
+        self.assertEqual([item['pubdate'] for item in result.items],
+                         [199, 200])
+        self.assertEqual(len(parsed), 3)
+        # the short rest of the body was drained, so the connection is reused
+        self.feeder.fetch('feed', 198)
+        self.assertEqual(self.feeder.pool.stats()['connections'], 1)
+
+    def test_missing_build_date(self):
+        self.server.body = b'<rss><channel></channel></rss>'
+        with self.assertRaises(ValueError):
+            self.feeder.fetch('feed', None)
+
+    def test_metrics(self):
+        responses = lambda status: metrics.FETCH_RESPONSES.values.get(
+            (status, ), 0
+        )
+        before = (responses(200), responses(304),
+                  metrics.FETCH_BYTES.values.get((), 0))
+        self.feeder.fetch('feed', None)
+        self.feeder.fetch('feed', None, etag='"v1"')
+        self.assertEqual(responses(200) - before[0], 1)
+        self.assertEqual(responses(304) - before[1], 1)
+        self.assertEqual(metrics.FETCH_BYTES.values[()] - before[2],
+                         len(self.server.body))
+
+    def test_cache_control_sets_expires(self):
+        self.server.extra_headers = {'Cache-Control': 'public, max-age=600',
+                                     'Age': '100'}
+        before = time.time()
+        result = self.feeder.fetch('feed', None)
+        self.assertAlmostEqual(result.expires, before + 500, delta=2)
+
+
+class ExpiresTest(unittest.TestCase):
+    def setUp(self):
+        self.feeder = SbFeedFeeder('http://sb', timeout=5)
+        self.now = time.time()
+
+    def test_max_age_minus_age(self):
+        self.assertAlmostEqual(
+            self.feeder._expires({'Cache-Control': 'max-age=120',
+                                  'Age': '20'}),
+            self.now + 100, delta=2
+        )
+
+    def test_expires_header(self):
+        self.assertAlmostEqual(
+            self.feeder._expires({'Expires': formatdate(self.now + 300)}),
+            self.now + 300, delta=2
+        )
+
+    def test_capped(self):
+        self.assertAlmostEqual(
+            self.feeder._expires({'Cache-Control': 'max-age=86400'}),
+            self.now + SbFeedFeeder.MAX_CACHE_AGE, delta=2
+        )
+
+    def test_not_cacheable(self):
+        for headers in [{},
+                        {'Cache-Control': 'no-cache, max-age=600'},
+                        {'Cache-Control': 'no-store'},
+                        {'Cache-Control': 'max-age=60', 'Age': '90'},
+                        {'Expires': 'garbage'},
+                        {'Expires': formatdate(self.now - 60)}]:
+            self.assertIsNone(self.feeder._expires(headers), headers)
+
+
+if __name__ == '__main__':
+    unittest.main()
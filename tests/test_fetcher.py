@@ -0,0 +1,144 @@
+import threading
+import unittest
+
+from sbfeed_bot.events import SbFeedEvents
+from sbfeed_bot.feed import FeedFetchResult
+from sbfeed_bot.fetcher import SbFeedFetcher
+
+
+class FakeFeeder:
+    def __init__(self, hosts):
+        # slug -> host it is served from
+        self.hosts = hosts
+        self.failing = set()
+        self.release = threading.Event()
+        self.lock = threading.Lock()
+        self.running = 0
+        self.max_running = 0
+        self.fetched = []
+
+    def feed_url(self, feed):
+        return 'http://%s/comments/feeds/%s' % (self.hosts[feed], feed)
+
+    def fetch(self, feed, not_before, etag=None):
+        with self.lock:
+            self.running += 1
+            self.max_running = max(self.max_running, self.running)
+        try:
+            self.release.wait(5)
+            if feed in self.failing:
+                raise OSError('connection refused')
+            with self.lock:
+                self.fetched.append(feed)
+            return FeedFetchResult(1000, [{'title': 'comment',
+                                           'link': 'http://sb/',
+                                           'text': 'text', 'pubdate': 1000}],
+                                   '"v1"', None)
+        finally:
+            with self.lock:
+                self.running -= 1
+
+
+class FakeModel:
+    def __init__(self, feeds):
+        self.feeds = feeds
+        self.processed = {}
+        self.stored = []
+        self.broken = set()
+        self.changed = {}
+        self.done = threading.Semaphore(0)
+        self.events = SbFeedEvents()
+
+    def get_fetches_needed(self, shards=None):
+        return [(feed, None, None, None) for feed in self.feeds]
+
+    def get_next_fetch_time(self, shards=None, exclude=()):
+        due = [feed for feed in self.feeds if feed not in exclude]
+        return 0 if due else None
+
+    def store_items(self, feed, items):
+        if feed in self.broken:
+            raise OSError('disk I/O error')
+        self.stored.extend((feed, item['pubdate']) for item in items)
+
+    def mark_feed_as_processed(self, feed, *, last_modified,
+                               etag=None, expires=None, changed=False):
+        self.processed[feed] = last_modified
+        self.changed[feed] = changed
+        self.done.release()
+
+
+class FetcherTest(unittest.TestCase):
+    def make_fetcher(self, hosts, concurrency=8, per_host=4):
+        self.feeder = FakeFeeder(hosts)
+        self.model = FakeModel(sorted(hosts))
+        fetcher = SbFeedFetcher(self.feeder, self.model,
+                                concurrency=concurrency, per_host=per_host)
+        self.addCleanup(fetcher.shutdown)
+        return fetcher
+
+    def wait_processed(self, count):
+        for _ in range(count):
+            self.assertTrue(self.model.done.acquire(timeout=5))
+
+    def test_failure_is_isolated(self):
+        fetcher = self.make_fetcher({'a': 'sb', 'b': 'sb', 'c': 'sb'})
+        self.feeder.failing.add('b')
+        self.feeder.release.set()
+        self.assertEqual(fetcher.schedule(), 3)
+        self.wait_processed(3)
+        self.assertEqual(self.model.processed,
+                         {'a': 1000, 'b': None, 'c': 1000})
+        self.assertEqual(sorted(self.model.stored),
+                         [('a', 1000), ('c', 1000)])
+        self.assertEqual(self.model.changed,
+                         {'a': True, 'b': False, 'c': True})
+
+    def test_failed_store_is_refetched(self):
+        fetcher = self.make_fetcher({'a': 'sb', 'b': 'sb'})
+        self.model.broken.add('a')
+        self.feeder.release.set()
+        fetcher.schedule()
+        self.wait_processed(2)
+        # last_modified of 'a' is not advanced, so its items come again
+        self.assertEqual(self.model.processed, {'a': None, 'b': 1000})
+        self.assertEqual(self.model.stored, [('b', 1000)])
+
+    def test_feeds_in_flight_are_skipped(self):
+        fetcher = self.make_fetcher({'a': 'sb', 'b': 'sb'})
+        self.assertEqual(fetcher.schedule(), 2)
+        # still blocked in fetch()
+        self.assertEqual(fetcher.schedule(), 0)
+        self.feeder.release.set()
+        self.wait_processed(2)
+        self.assertEqual(fetcher.schedule(), 2)
+        self.wait_processed(2)
+
+    def test_feeds_in_flight_signal_when_done(self):
+        fetcher = self.make_fetcher({'a': 'sb', 'b': 'sb'})
+        self.assertEqual(fetcher.next_fetch_time(), 0)
+        fetcher.schedule()
+        # due, but nothing to wait for until they are processed
+        self.assertIsNone(fetcher.next_fetch_time())
+        self.model.events.feeds_changed.wait(0)
+        self.feeder.release.set()
+        self.wait_processed(2)
+        # until both have left in_flight
+        fetcher.executor.shutdown(wait=True)
+        self.assertTrue(self.model.events.feeds_changed.wait(0))
+        self.assertEqual(fetcher.next_fetch_time(), 0)
+
+    def test_per_host_limit(self):
+        hosts = dict(('sb-%d' % (index, ), 'sb') for index in range(6))
+        hosts.update(('other-%d' % (index, ), 'other')
+                     for index in range(6))
+        fetcher = self.make_fetcher(hosts, concurrency=12, per_host=2)
+        fetcher.schedule()
+        threading.Timer(0.2, self.feeder.release.set).start()
+        self.wait_processed(12)
+        # two hosts, at most two requests to each at a time
+        self.assertEqual(self.feeder.max_running, 4)
+
+
+if __name__ == '__main__':
+    unittest.main()
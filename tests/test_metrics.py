@@ -0,0 +1,61 @@
+import unittest
+from urllib.request import urlopen
+from urllib.error import HTTPError
+
+from sbfeed_bot import metrics
+
+
+class MetricsTest(unittest.TestCase):
+    def test_counter(self):
+        counter = metrics.Counter('test_total', 'Things.', labels=['kind'])
+        counter.inc('a')
+        counter.inc('a', amount=2)
+        counter.inc('b"\n')
+        self.assertEqual(counter.render(), [
+            '# HELP test_total Things.',
+            '# TYPE test_total counter',
+            'test_total{kind="a"} 3',
+            'test_total{kind="b\\"\\n"} 1',
+        ])
+
+    def test_gauge_callback(self):
+        gauge = metrics.Gauge('test_backlog', 'Backlog.')
+        gauge.set_function(lambda: 42)
+        self.assertEqual(gauge.render()[-1], 'test_backlog 42')
+        gauge.set_function(lambda: 1 / 0)
+        # a failing callback keeps the last value
+        self.assertEqual(gauge.render()[-1], 'test_backlog 42')
+
+    def test_histogram(self):
+        histogram = metrics.Histogram('test_seconds', 'Time.',
+                                      buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.1)
+        histogram.observe(5)
+        self.assertEqual(histogram.render()[2:], [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 2',
+            'test_seconds_bucket{le="+Inf"} 3',
+            'test_seconds_sum 5.15',
+            'test_seconds_count 3',
+        ])
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.render()[-1], 'test_seconds_count 4')
+
+    def test_endpoint(self):
+        server = metrics.start_server(0)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        url = 'http://127.0.0.1:%d' % (server.server_address[1], )
+        metrics.FETCH_ERRORS.inc()
+        with urlopen(url + '/metrics') as response:
+            body = response.read().decode('utf-8')
+        self.assertIn('# TYPE sbfeed_fetch_errors_total counter\n', body)
+        self.assertIn('sbfeed_transaction_seconds', body)
+        with self.assertRaises(HTTPError):
+            urlopen(url + '/')
+
+
+if __name__ == '__main__':
+    unittest.main()
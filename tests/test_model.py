@@ -0,0 +1,424 @@
+import os
+import sqlite3
+import tempfile
+import time
+import unittest
+
+from sbfeed_bot import exceptions
+from sbfeed_bot.events import SbFeedEvents
+from sbfeed_bot.model import SbFeedModel
+from sbfeed_bot.schedule import SbFeedSchedule
+from sbfeed_bot.storage import transaction
+
+
+class ModelTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.dbfile = os.path.join(tmpdir.name, 'sbfeed.db')
+        self.model = SbFeedModel(self.dbfile)
+        self.addCleanup(self.model.close)
+        self.model.create_db()
+
+
+class FetchScheduleTest(ModelTestCase):
+    def test_etag_and_expires_are_stored(self):
+        # poll as often as the upstream cache hints allow
+        self.model.schedule = SbFeedSchedule(min_interval=0)
+        self.model.init_feed('a')
+        self.model.init_feed('b')
+        self.assertEqual(sorted(self.model.get_fetches_needed()),
+                         [('a', None, None, None), ('b', None, None, None)])
+        self.model.mark_feed_as_processed('a', last_modified=1000,
+                                          etag='"v1"',
+                                          expires=int(time.time()) + 600)
+        self.model.mark_feed_as_processed('b', last_modified=2000,
+                                          etag='"v2"', expires=None)
+        # 'a' is still fresh according to its Cache-Control
+        [(slug, last_modified, _, etag)] = self.model.get_fetches_needed()
+        self.assertEqual((slug, last_modified, etag), ('b', 2000, '"v2"'))
+
+    def test_expired_feed_is_fetched(self):
+        self.model.schedule = SbFeedSchedule(min_interval=0)
+        self.model.init_feed('a')
+        self.model.mark_feed_as_processed('a', last_modified=1000,
+                                          etag='"v1"',
+                                          expires=int(time.time()) - 1)
+        self.assertEqual([row[0] for row in self.model.get_fetches_needed()],
+                         ['a'])
+
+
+    def schedule_of(self, feed):
+        with self.model._connection() as conn:
+            return conn.execute(
+                "SELECT fetch_interval, fetch_errors, next_fetch - ? "
+                "FROM feed WHERE slug = ?", [int(time.time()), feed]
+            ).fetchone()
+
+    def test_interval_adapts(self):
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.model.mark_feed_as_processed('a', last_modified=1000)
+        interval, errors, due_in = self.schedule_of('a')
+        self.assertEqual((interval, errors), (10, 0))
+        self.assertAlmostEqual(due_in, 10, delta=1)
+        self.model.mark_feed_as_processed('a', last_modified=1000)
+        self.assertEqual(self.schedule_of('a')[0], 15)
+        self.model.mark_feed_as_processed('a', last_modified=2000,
+                                          changed=True)
+        self.assertEqual(self.schedule_of('a')[0], 10)
+        self.assertEqual(self.model.get_fetches_needed(), [])
+
+    def test_errors_back_off(self):
+        self.model.init_feed('a')
+        for errors, delay in [(1, 30), (2, 60), (3, 120)]:
+            self.model.mark_feed_as_processed('a', last_modified=None)
+            _, stored_errors, due_in = self.schedule_of('a')
+            self.assertEqual(stored_errors, errors)
+            self.assertAlmostEqual(due_in, delay, delta=1)
+        self.model.mark_feed_as_processed('a', last_modified=1000)
+        self.assertEqual(self.schedule_of('a')[1], 0)
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.mark_feed_as_processed('b', last_modified=None)
+
+
+class SubscriptionTest(ModelTestCase):
+    def test_commands(self):
+        self.model.init_feed('a')
+        self.assertTrue(self.model.check_feed_is_known('a'))
+        self.model.subscribe(1, 'a')
+        with self.assertRaises(exceptions.AlreadyExistsError):
+            self.model.subscribe(1, 'a')
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.subscribe(1, 'b')
+        self.assertEqual(self.model.list_subscriptions(1), ['a'])
+        self.model.unsubscribe(1, 'a')
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.unsubscribe(1, 'a')
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.unsubscribe_all(1)
+        self.assertEqual(self.model.list_subscriptions(1), [])
+
+    def test_changes_of_other_processes_are_seen(self):
+        # e.g. a worker forgets a chat that blocked the bot, while the
+        # main process answers its commands
+        worker = SbFeedModel(self.dbfile)
+        self.addCleanup(worker.close)
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.assertEqual(self.model.list_subscriptions(1), ['a'])
+        worker.forget_chat(1)
+        self.assertEqual(self.model.list_subscriptions(1), [])
+        self.model.subscribe(1, 'a')
+        worker.forget_chat(1)
+        worker.collect_orphan_feeds(-1)
+        self.assertFalse(self.model.check_feed_is_known('a'))
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.subscribe(1, 'a')
+
+
+class BatchTest(ModelTestCase):
+    def items(self, *pubdates):
+        return [{'title': 'comment %d' % (pubdate, ), 'link': 'http://sb/',
+                 'text': 'text', 'pubdate': pubdate}
+                for pubdate in pubdates]
+
+    def test_store_items(self):
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        now = int(time.time())
+        self.assertEqual(
+            self.model.store_items('a', self.items(now + 1, now + 2)), 2
+        )
+        # storing again is harmless
+        self.assertEqual(
+            self.model.store_items('a', self.items(now + 2, now + 3)), 1
+        )
+        self.assertEqual(
+            [item['item_pub_date']
+             for item in self.model.check_notifications_needed()],
+            [now + 1, now + 2, now + 3]
+        )
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.store_items('b', self.items(now))
+
+    def test_enqueue_notifications(self):
+        now = int(time.time())
+        for feed in 'ab':
+            self.model.init_feed(feed)
+            self.model.subscribe(1, feed)
+            self.model.subscribe(2, feed)
+            self.model.store_items(feed, self.items(now + 1, now + 2))
+        messages = [(1, 'a', [now + 1, now + 2]), (2, 'a', [now + 1]),
+                    (1, 'b', [now + 1]), (1, 'b', [now + 2])]
+        notifications = [(1, 'a', now + 2), (2, 'a', now + 1),
+                         (1, 'b', now + 2)]
+        self.assertEqual(
+            self.model.enqueue_notifications(messages, notifications), 4
+        )
+        self.assertEqual(
+            sorted((item['chat_id'], item['feed'], item['item_pub_date'])
+                   for item in self.model.check_notifications_needed()),
+            [(2, 'a', now + 2), (2, 'b', now + 1), (2, 'b', now + 2)]
+        )
+        # the same batch again inserts nothing
+        self.assertEqual(
+            self.model.enqueue_notifications(messages, notifications), 0
+        )
+
+
+class PendingNotificationsTest(BatchTest):
+    def test_keyset_pages(self):
+        now = int(time.time())
+        for feed in 'ab':
+            self.model.init_feed(feed)
+            for chat_id in (1, 2):
+                self.model.subscribe(chat_id, feed)
+            self.model.store_items(feed, self.items(now + 1, now + 2))
+        # nothing new in 'c'
+        self.model.init_feed('c')
+        self.model.subscribe(1, 'c')
+        pages = []
+        after = None
+        while True:
+            page = self.model.check_notifications_needed(limit=3,
+                                                         after=after)
+            if not page:
+                break
+            pages.append([(item['feed'], item['chat_id'],
+                           item['item_pub_date']) for item in page])
+            after = pages[-1][-1]
+        self.assertEqual([len(page) for page in pages], [3, 3, 2])
+        self.assertEqual(sum(pages, []), [
+            (feed, chat_id, now + index)
+            for feed in 'ab' for chat_id in (1, 2) for index in (1, 2)
+        ])
+
+    def test_get_items(self):
+        self.model.GET_ITEMS_CHUNK = 2
+        self.model.init_feed('a')
+        self.model.init_feed('b')
+        self.model.store_items('a', self.items(1, 2, 3))
+        self.model.store_items('b', self.items(1))
+        items = self.model.get_items([('a', 1), ('a', 2), ('a', 3),
+                                      ('b', 1), ('b', 2)])
+        self.assertEqual(sorted(items), [('a', 1), ('a', 2), ('a', 3),
+                                         ('b', 1)])
+        self.assertEqual(items['a', 3]['item_title'], 'comment 3')
+
+    def test_sent_items_are_skipped(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.model.store_items('a', self.items(now + 1, now + 2))
+        self.model.enqueue_notifications([], [(1, 'a', now + 2)])
+        self.assertEqual(self.model.check_notifications_needed(), [])
+
+
+class RetentionTest(BatchTest):
+    def test_prune_delivered_items(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.model.subscribe(2, 'a')
+        self.model.store_items('a', self.items(now + 10, now + 20, now + 30))
+        self.model.enqueue_notifications([], [(1, 'a', now + 30),
+                                              (2, 'a', now + 20)])
+        # too young to go yet
+        self.assertEqual(self.model.prune_items(0), 0)
+        # chat 2 still waits for the newest one
+        self.assertEqual(self.model.prune_items(-3600), 2)
+        self.assertEqual(
+            [(item['chat_id'], item['item_pub_date'])
+             for item in self.model.check_notifications_needed()],
+            [(2, now + 30)]
+        )
+
+    def test_unsubscribed_items_wait_for_min_age(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.store_items('a', self.items(now - 20, now - 10))
+        self.assertEqual(self.model.prune_items(3600), 0)
+        self.assertEqual(self.model.prune_items(15), 1)
+        self.assertEqual(list(self.model.get_items([('a', now - 10)])),
+                         [('a', now - 10)])
+
+    def test_queued_items_are_kept(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.model.store_items('a', self.items(now + 10, now + 20))
+        # the subscription moved on, the newest item waits in the outbox
+        self.model.enqueue_notifications([(1, 'a', [now + 20])],
+                                         [(1, 'a', now + 20)])
+        self.assertEqual(self.model.prune_items(-3600), 1)
+        self.assertEqual(list(self.model.get_items([('a', now + 20)])),
+                         [('a', now + 20)])
+        [message] = self.model.claim_outbox('worker', 10, 60)
+        self.model.finish_outbox('worker',
+                                 [(message['id'], 'sent', 1, 0, None)])
+        self.assertEqual(self.model.prune_outbox(3600), 0)
+        self.assertEqual(self.model.prune_outbox(-1), 1)
+        self.assertEqual(self.model.prune_items(-3600), 1)
+
+    def test_collect_orphan_feeds(self):
+        self.model.init_feed('a')
+        self.model.init_feed('b')
+        self.model.subscribe(1, 'a')
+        # just created, may be subscribed to any moment
+        self.assertEqual(self.model.collect_orphan_feeds(3600), 0)
+        self.assertEqual(self.model.collect_orphan_feeds(-1), 1)
+        self.assertTrue(self.model.check_feed_is_known('a'))
+        self.assertFalse(self.model.check_feed_is_known('b'))
+
+    def test_vacuum(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.store_items('a', [
+            {'title': 'comment', 'link': 'http://sb/', 'text': 'x' * 4096,
+             'pubdate': now - index}
+            for index in range(1, 200)
+        ])
+        self.model.collect_orphan_feeds(-1)
+        self.assertEqual(self.model.vacuum(), 0)
+        self.assertLess(os.path.getsize(self.dbfile), 100 * 1024)
+
+
+class OutboxTest(BatchTest):
+    def test_claims_are_leased(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        self.model.subscribe(1, 'a')
+        self.model.store_items('a', self.items(now + 1))
+        self.model.enqueue_notifications([(1, 'a', [now + 1])],
+                                         [(1, 'a', now + 1)])
+        [message] = self.model.claim_outbox('first', 10, 60)
+        self.assertEqual(message['pubdates'], [now + 1])
+        self.assertEqual(self.model.claim_outbox('second', 10, 60), [])
+        # the first worker died, its lease runs out
+        with self.model._connection() as conn:
+            conn.execute("UPDATE outbox SET claimed_until = 0")
+        [again] = self.model.claim_outbox('second', 10, 60)
+        self.assertEqual(again['id'], message['id'])
+        update = [(message['id'], 'sent', 1, 0, None)]
+        self.assertEqual(self.model.finish_outbox('first', update), 0)
+        self.assertEqual(self.model.finish_outbox('second', update), 1)
+        self.assertEqual(self.model.claim_outbox('first', 10, 60), [])
+
+    def test_forget_chat(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        for chat_id in (1, 2):
+            self.model.subscribe(chat_id, 'a')
+        self.model.store_items('a', self.items(now + 1))
+        self.model.enqueue_notifications(
+            [(1, 'a', [now + 1]), (2, 'a', [now + 1])],
+            [(1, 'a', now + 1), (2, 'a', now + 1)]
+        )
+        self.assertEqual(self.model.forget_chat(1), 1)
+        self.assertEqual(self.model.list_subscriptions(1), [])
+        self.assertEqual([message['chat_id'] for message
+                          in self.model.claim_outbox('worker', 10, 60)], [2])
+
+
+class EventsTest(BatchTest):
+    def setUp(self):
+        super().setUp()
+        self.model.events = SbFeedEvents()
+
+    def test_signals_fire_after_commit(self):
+        events = self.model.events
+        self.model.init_feed('a')
+        self.assertTrue(events.feeds_changed.wait(0))
+        self.model.store_items('a', self.items(1000))
+        self.assertTrue(events.items_stored.wait(0))
+        self.model.mark_feed_as_processed('a', last_modified=1000)
+        self.assertTrue(events.feeds_changed.wait(0))
+        # nothing is signalled for reads or failed writes
+        self.model.check_notifications_needed()
+        with self.assertRaises(exceptions.NotExistError):
+            self.model.store_items('b', self.items(1000))
+        self.assertFalse(events.items_stored.wait(0))
+        self.assertFalse(events.feeds_changed.wait(0))
+
+    def test_next_fetch_time(self):
+        self.assertIsNone(self.model.get_next_fetch_time())
+        self.model.init_feed('a')
+        self.assertEqual(self.model.get_next_fetch_time(), 0)
+        self.assertIsNone(self.model.get_next_fetch_time(exclude={'a'}))
+        self.model.mark_feed_as_processed('a', last_modified=1000)
+        self.assertAlmostEqual(self.model.get_next_fetch_time(),
+                               time.time() + 10, delta=1)
+
+
+class WritingModel(SbFeedModel):
+    @transaction(readonly=True)
+    def write_in_readonly(self, cursor, feed):
+        cursor.execute("DELETE FROM feed WHERE slug = ?", [feed])
+
+
+class ReadonlyTransactionTest(ModelTestCase):
+    def setUp(self):
+        super().setUp()
+        self.model = WritingModel(self.dbfile)
+        self.addCleanup(self.model.close)
+        self.model.init_feed('gig')
+
+    def test_readonly_transaction_can_not_write(self):
+        with self.assertRaises(sqlite3.OperationalError):
+            self.model.write_in_readonly('gig')
+        self.assertTrue(self.model.check_feed_is_known('gig'))
+
+    def test_writers_are_not_readonly(self):
+        # a reader connection must not be handed out to a writer
+        self.model.check_feed_is_known('gig')
+        self.model.subscribe(1, 'gig')
+        self.assertEqual(self.model.list_subscriptions(1), ['gig'])
+
+
+class UpgradeTest(unittest.TestCase):
+    def test_old_schema_is_upgraded(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        dbfile = os.path.join(tmpdir.name, 'sbfeed.db')
+        conn = sqlite3.connect(dbfile)
+        # the schema before any migrations
+        conn.executescript("""
+            CREATE TABLE feed (slug varchar(255), last_modified integer,
+                               last_tried_to_fetch integer,
+                               PRIMARY KEY (slug));
+            CREATE TABLE feed_item (feed varchar(255), title text,
+                                    link varchar(255), text text,
+                                    pubdate integer,
+                                    PRIMARY KEY (feed, pubdate));
+            CREATE TABLE subscription (chat_id integer, feed varchar(255),
+                                       last_notified integer,
+                                       PRIMARY KEY (feed, chat_id));
+            INSERT INTO feed VALUES ('a', 1000, NULL);
+            INSERT INTO feed_item VALUES ('a', 'title', 'link', 'text', 900);
+            INSERT INTO subscription VALUES (1, 'a', 800);
+        """)
+        conn.close()
+        model = SbFeedModel(dbfile)
+        self.addCleanup(model.close)
+        model.upgrade_db()
+        model.upgrade_db()
+        self.assertEqual(model.get_fetches_needed(),
+                         [('a', 1000, None, None)])
+        # last_pubdate is filled in for existing items
+        self.assertEqual([item['item_pub_date']
+                          for item in model.check_notifications_needed()],
+                         [900])
+        # a full rebuild only runs when asked for
+        self.assertEqual(self.auto_vacuum(model), 0)
+        model.rebuild_db()
+        self.assertEqual(self.auto_vacuum(model), 2)
+        self.assertEqual(len(model.get_fetches_needed()), 1)
+
+    def auto_vacuum(self, model):
+        with model._connection() as conn:
+            return conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,357 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized
+
+from sbfeed_bot.bot import SbFeedBot
+from sbfeed_bot.model import SbFeedModel
+from sbfeed_bot.notifier import RenderCache, SbFeedNotifier, TokenBucket
+
+
+class FakeBot(SbFeedBot):
+    # renders like the real bot, sends nowhere
+    def __init__(self):
+        self.sent = []
+        # chat_id -> number of RetryAfter errors to raise before sending
+        self.flood = {}
+        # chat_id -> exception to raise instead of sending
+        self.errors = {}
+        self.error_once = False
+        self.token_valid = True
+        self.lock = threading.Lock()
+
+    def send_text(self, chat_id, text):
+        with self.lock:
+            if self.flood.get(chat_id):
+                self.flood[chat_id] -= 1
+                raise RetryAfter(0.1)
+            error = self.errors.get(chat_id)
+            if error is not None:
+                if self.error_once:
+                    del self.errors[chat_id]
+                raise error
+            self.sent.append((chat_id, text))
+
+    def token_is_valid(self):
+        return self.token_valid
+
+    def titles(self, chat_id):
+        return [text.split('\n')[0] for chat, text in self.sent
+                if chat == chat_id]
+
+
+class TokenBucketTest(unittest.TestCase):
+    def test_burst_then_paced(self):
+        bucket = TokenBucket(rate=10, capacity=2)
+        self.assertEqual(bucket.reserve(), 0)
+        self.assertEqual(bucket.reserve(), 0)
+        # tokens are taken in advance, every next one is due 1/rate later
+        self.assertAlmostEqual(bucket.reserve(), 0.1, delta=0.01)
+        self.assertAlmostEqual(bucket.reserve(), 0.2, delta=0.01)
+
+    def test_acquire_paces(self):
+        bucket = TokenBucket(rate=50, capacity=1)
+        started = time.monotonic()
+        for _ in range(6):
+            bucket.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.09)
+
+    def test_pause(self):
+        bucket = TokenBucket(rate=10, capacity=5)
+        bucket.pause(2)
+        self.assertAlmostEqual(bucket.reserve(), 2.1, delta=0.01)
+
+    def test_set_rate_and_idle(self):
+        bucket = TokenBucket(rate=1, capacity=1)
+        bucket.reserve()
+        self.assertFalse(bucket.is_idle(time.monotonic()))
+        self.assertTrue(bucket.is_idle(time.monotonic() + 1))
+        bucket.set_rate(100)
+        self.assertAlmostEqual(bucket.reserve(), 0.01, delta=0.01)
+
+
+class NotifierTestCase(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.model = SbFeedModel(os.path.join(tmpdir.name, 'sbfeed.db'))
+        self.addCleanup(self.model.close)
+        self.model.create_db()
+        self.bot = FakeBot()
+        self.positions = []
+        self.loaded = []
+        check_notifications_needed = self.model.check_notifications_needed
+        get_items = self.model.get_items
+
+        def recording_check(limit, after=None, shards=None):
+            self.positions.append(after)
+            return check_notifications_needed(limit=limit, after=after,
+                                              shards=shards)
+
+        def recording_get_items(keys):
+            self.loaded.append(sorted(keys))
+            return get_items(keys)
+
+        self.model.check_notifications_needed = recording_check
+        self.model.get_items = recording_get_items
+
+    def make_notifier(self, rate=1000, digest_window=None, batch_size=10):
+        notifier = SbFeedNotifier(self.model, self.bot, concurrency=4,
+                                  rate=rate, batch_size=batch_size,
+                                  digest_window=digest_window)
+        self.addCleanup(notifier.shutdown)
+        return notifier
+
+    def add_items(self, chats, pubdates, feed='gig'):
+        # subscriptions start at now, these see every item of the feed
+        if not self.model.check_feed_is_known(feed):
+            self.model.init_feed(feed)
+        for chat_id in chats:
+            self.model.subscribe(chat_id, feed)
+        with self.model._connection() as conn:
+            conn.execute("UPDATE subscription SET last_notified = 0")
+        self.model.store_items(feed, [
+            {'title': '%s %d' % (feed, pubdate), 'link': 'http://sb/',
+             'text': 'text', 'pubdate': pubdate}
+            for pubdate in pubdates
+        ])
+
+    def outbox(self, chat_id):
+        with self.model._connection() as conn:
+            return conn.execute(
+                "SELECT state, attempts, next_attempt > ? FROM outbox "
+                "WHERE chat_id = ? ORDER BY id", [time.time(), chat_id]
+            ).fetchall()
+
+    def pending(self):
+        return sorted((item['chat_id'], item['item_pub_date']) for item
+                      in self.model.check_notifications_needed(limit=100))
+
+
+class NotifierTest(NotifierTestCase):
+    def test_chat_order_is_kept(self):
+        notifier = self.make_notifier()
+        self.add_items([1, 2], [1, 2, 3])
+        # six items enqueued, then six messages claimed
+        self.assertEqual(notifier.run_once(), 12)
+        for chat_id in (1, 2):
+            self.assertEqual(self.bot.titles(chat_id),
+                             ['gig 1', 'gig 2', 'gig 3'])
+            self.assertEqual(self.outbox(chat_id), [('sent', 1, 0)] * 3)
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(notifier.run_once(), 0)
+
+    def test_batch_size(self):
+        notifier = self.make_notifier()
+        self.add_items(range(1, 13), [1])
+        self.assertEqual(notifier.run_once(), 20)
+        self.assertEqual(notifier.run_once(), 4)
+        # the next page starts after the last item, an empty page restarts
+        self.assertEqual(notifier.run_once(), 0)
+        self.assertEqual(self.positions,
+                         [None, ('gig', 10, 1), ('gig', 12, 1), None])
+
+    def test_retry_after_slows_down(self):
+        notifier = self.make_notifier(rate=20)
+        self.add_items([1], [1])
+        self.bot.flood[1] = 1
+        notifier.run_once()
+        self.assertEqual(self.bot.sent, [(1, 'gig 1\n\ntext\n\nhttp://sb/')])
+        self.assertEqual(self.outbox(1), [('sent', 1, 0)])
+        self.assertLess(notifier.global_bucket.rate, 20)
+
+    def test_flood_control_is_retried_later(self):
+        notifier = self.make_notifier()
+        notifier.MAX_ATTEMPTS = 2
+        self.add_items([1], [1])
+        self.bot.flood[1] = 5
+        notifier.run_once()
+        self.assertEqual(self.bot.sent, [])
+        # the message waits for a retry instead of being dropped
+        self.assertEqual(self.outbox(1), [('pending', 1, 1)])
+        self.assertEqual(self.pending(), [])
+        self.assertAlmostEqual(notifier.wait_time(300),
+                               SbFeedNotifier.RETRY_DELAY, delta=1)
+
+    def test_digest_is_held_back(self):
+        now = int(time.time())
+        notifier = self.make_notifier(digest_window=60)
+        self.add_items([1], [now - 100, now - 50])
+        self.add_items([2], [now - 10], feed='other')
+        # chat 2 has to wait for its window to pass
+        self.assertEqual(notifier.run_once(), 3)
+        self.assertEqual(self.bot.titles(1), ['gig %d' % (now - 100, )])
+        self.assertEqual(self.bot.sent[0][1].count(SbFeedBot.DIGEST_SEPARATOR),
+                         1)
+        self.assertEqual(self.pending(), [(2, now - 10)])
+        self.assertAlmostEqual(notifier.wait_time(300), 50, delta=2)
+        self.assertEqual(self.bot.titles(2), [])
+
+    def test_items_are_rendered_once(self):
+        notifier = self.make_notifier()
+        self.add_items([1, 2, 3], [1, 2])
+        notifier.run_once()
+        self.assertEqual(len(self.bot.sent), 6)
+        # one lookup for the batch, every item once
+        self.assertEqual(self.loaded, [[('gig', 1), ('gig', 2)]])
+        self.add_items([4], [])
+        notifier.run_once()
+        self.assertEqual(self.bot.titles(4), ['gig 1', 'gig 2'])
+        self.assertEqual(len(self.loaded), 1)
+
+    def test_pruned_item_is_skipped(self):
+        notifier = self.make_notifier()
+        self.add_items([1], [1, 2])
+        notifier.enqueue(notifier.next_batch())
+        with self.model._connection() as conn:
+            conn.execute("DELETE FROM feed_item WHERE pubdate = 1")
+        self.assertEqual(notifier.run_once(), 2)
+        self.assertEqual(self.bot.titles(1), ['gig 2'])
+        self.assertEqual(self.outbox(1), [('failed', 1, 0), ('sent', 1, 0)])
+
+
+class OutboxTest(NotifierTestCase):
+    def test_enqueued_once(self):
+        notifier = self.make_notifier()
+        self.add_items([1], [1, 2])
+        items = notifier.next_batch()
+        self.assertEqual(notifier.enqueue(items), 2)
+        # a batch picked twice, e.g. by a worker that died meanwhile
+        self.assertEqual(notifier.enqueue(items), 0)
+        self.assertEqual(self.pending(), [])
+        self.assertEqual(len(notifier.claim()), 2)
+
+    def test_retry_keeps_order(self):
+        notifier = self.make_notifier()
+        self.add_items([1, 2], [1, 2])
+        self.bot.errors[1] = NetworkError('connection reset')
+        notifier.run_once()
+        # the second message waits behind the first one
+        self.assertEqual(self.outbox(1), [('pending', 1, 1),
+                                          ('pending', 0, 0)])
+        self.assertEqual(self.outbox(2), [('sent', 1, 0), ('sent', 1, 0)])
+        self.assertIsNotNone(notifier.next_retry)
+        self.assertEqual(notifier.claim(), [])
+
+    def test_gives_up_after_max_attempts(self):
+        notifier = self.make_notifier()
+        self.add_items([1], [1])
+        self.bot.errors[1] = NetworkError('connection reset')
+        notifier.enqueue(notifier.next_batch())
+        with self.model._connection() as conn:
+            conn.execute("UPDATE outbox SET attempts = ?",
+                         [SbFeedNotifier.OUTBOX_MAX_ATTEMPTS - 1])
+        notifier.run_once()
+        self.assertEqual(self.outbox(1), [
+            ('failed', SbFeedNotifier.OUTBOX_MAX_ATTEMPTS, 0),
+        ])
+
+    def test_rejected_lets_the_next_message_go(self):
+        notifier = self.make_notifier()
+        self.add_items([1], [1, 2])
+        self.bot.errors[1] = BadRequest('message is too long')
+        self.bot.error_once = True
+        notifier.run_once()
+        self.assertEqual(self.outbox(1), [('failed', 1, 0), ('sent', 1, 0)])
+        self.assertEqual(self.bot.titles(1), ['gig 2'])
+
+    def test_blocked_chat_is_forgotten(self):
+        notifier = self.make_notifier()
+        self.add_items([1, 2], [1, 2])
+        self.bot.errors[1] = Unauthorized()
+        notifier.run_once()
+        self.assertEqual(self.outbox(1), [])
+        self.assertEqual(self.model.list_subscriptions(1), [])
+        self.assertEqual(self.model.list_subscriptions(2), ['gig'])
+
+    def test_missing_chat_is_forgotten(self):
+        notifier = self.make_notifier()
+        self.add_items([1], [1])
+        self.bot.errors[1] = BadRequest('Bad Request: chat not found')
+        notifier.run_once()
+        self.assertEqual(self.outbox(1), [])
+        self.assertEqual(self.model.list_subscriptions(1), [])
+
+    def test_rejected_token_forgets_nobody(self):
+        notifier = self.make_notifier(batch_size=100)
+        chats = [1, 2, 3, -4, -5, -6]
+        for feed in ('gig-a', 'gig-b', 'gig-c'):
+            self.add_items(chats, [1], feed=feed)
+        for chat_id in chats:
+            self.bot.errors[chat_id] = Unauthorized()
+        self.bot.token_valid = False
+        notifier.run_once()
+        for chat_id in chats:
+            self.assertEqual(self.model.list_subscriptions(chat_id),
+                             ['gig-a', 'gig-b', 'gig-c'])
+            self.assertEqual([(state, attempts) for state, attempts, _
+                              in self.outbox(chat_id)], [('pending', 0)] * 3)
+        # delivery is paused rather than failing every message
+        self.assertTrue(notifier.is_paused())
+        self.assertEqual(notifier.claim(), [])
+        self.assertGreater(notifier.wait_time(300), 0)
+
+        # once the token works again, everything goes out in order
+        self.bot.errors.clear()
+        self.bot.token_valid = True
+        notifier.paused_until = time.time()
+        with self.model._connection() as conn:
+            conn.execute("UPDATE outbox SET next_attempt = 0")
+        notifier.run_once()
+        self.assertEqual(len(self.bot.sent), 18)
+        self.assertEqual(self.bot.titles(1), ['gig-a 1', 'gig-b 1', 'gig-c 1'])
+
+
+class DigestTest(unittest.TestCase):
+    def setUp(self):
+        self.bot = FakeBot()
+
+    def texts(self, *sizes):
+        return [self.bot.render('gig', 'title %d' % (index, ), 'http://sb/',
+                                'x' * size, index)
+                for index, size in enumerate(sizes)]
+
+    def test_messages_fit_the_limit(self):
+        messages = self.bot.pack_digest(self.texts(*[1000] * 10))
+        self.assertEqual([count for _, count in messages], [3, 3, 3, 1])
+        self.assertTrue(all(len(message) <= SbFeedBot.MAX_MESSAGE_LENGTH
+                            for message, _ in messages))
+        self.assertEqual([message.count('title ') for message, _ in messages],
+                         [3, 3, 3, 1])
+
+    def test_exact_fit(self):
+        # two renders and a separator take exactly 4096 characters
+        overhead = len(self.texts(0)[0])
+        first = 1000
+        second = (SbFeedBot.MAX_MESSAGE_LENGTH
+                  - len(SbFeedBot.DIGEST_SEPARATOR)) - 2 * overhead - first
+        messages = self.bot.pack_digest(self.texts(first, second))
+        self.assertEqual([(len(message), count) for message, count
+                          in messages],
+                         [(SbFeedBot.MAX_MESSAGE_LENGTH, 2)])
+        messages = self.bot.pack_digest(self.texts(first, second + 1))
+        self.assertEqual(len(messages), 2)
+
+    def test_long_item_is_truncated(self):
+        [(message, _)] = self.bot.pack_digest(self.texts(10000))
+        self.assertEqual(len(message), SbFeedBot.MAX_MESSAGE_LENGTH)
+        self.assertTrue(message.endswith('\u2026'))
+
+
+class RenderCacheTest(unittest.TestCase):
+    def test_least_recently_used_is_evicted(self):
+        cache = RenderCache(2)
+        cache.put(('gig', 1), 'one')
+        cache.put(('gig', 2), 'two')
+        self.assertEqual(cache.get(('gig', 1)), 'one')
+        cache.put(('gig', 3), 'three')
+        self.assertIsNone(cache.get(('gig', 2)))
+        self.assertEqual(cache.get(('gig', 1)), 'one')
+        self.assertEqual(cache.get(('gig', 3)), 'three')
+
+
+if __name__ == '__main__':
+    unittest.main()
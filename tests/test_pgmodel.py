@@ -0,0 +1,107 @@
+import os
+import time
+import unittest
+
+# smoke test against a live server, e.g.
+# SBFEED_TEST_POSTGRES=postgresql://postgres@localhost/postgres
+# a scratch database is created next to the given one and dropped after
+DSN = os.environ.get('SBFEED_TEST_POSTGRES')
+
+if DSN:
+    import psycopg2
+    from psycopg2.extensions import make_dsn
+
+    from sbfeed_bot.pgmodel import SbFeedPgModel
+
+
+def item(pubdate):
+    return {'title': 'comment %d' % (pubdate, ), 'link': 'http://sb/',
+            'text': 'text', 'pubdate': pubdate}
+
+
+@unittest.skipUnless(DSN, 'SBFEED_TEST_POSTGRES is not set')
+class PgModelSmokeTest(unittest.TestCase):
+    def setUp(self):
+        dbname = 'sbfeed_test_%d' % (os.getpid(), )
+        admin = psycopg2.connect(DSN)
+        admin.autocommit = True
+        self.addCleanup(admin.close)
+        with admin.cursor() as cursor:
+            cursor.execute('DROP DATABASE IF EXISTS %s' % (dbname, ))
+            cursor.execute('CREATE DATABASE %s' % (dbname, ))
+        self.addCleanup(self._drop, admin, dbname)
+        self.model = SbFeedPgModel(make_dsn(DSN, dbname=dbname),
+                                   max_connections=4)
+        self.addCleanup(self.model.close)
+        self.model.create_db()
+
+    def _drop(self, admin, dbname):
+        with admin.cursor() as cursor:
+            cursor.execute('DROP DATABASE IF EXISTS %s' % (dbname, ))
+
+    def test_feed_to_outbox(self):
+        model = self.model
+        model.upgrade_db()
+        model.init_feed('gig')
+        model.subscribe(1, 'gig')
+        model.subscribe(-2, 'gig')
+        self.assertEqual(model.list_subscriptions(1), ['gig'])
+        self.assertEqual([row[0] for row in model.get_fetches_needed()],
+                         ['gig'])
+        now = int(time.time())
+        self.assertEqual(model.store_items('gig', [item(now + 1),
+                                                   item(now + 2)]), 2)
+        model.mark_feed_as_processed('gig', last_modified=now,
+                                     changed=True)
+        self.assertEqual(model.count_due_subscriptions(), 2)
+
+        due = model.check_notifications_needed(limit=10)
+        self.assertEqual(len(due), 4)
+        self.assertEqual(set(model.get_items(
+            [('gig', now + 1), ('gig', now + 2)]
+        )), {('gig', now + 1), ('gig', now + 2)})
+        messages = [(chat_id, 'gig', [now + 1, now + 2])
+                    for chat_id in (1, -2)]
+        advanced = [(chat_id, 'gig', now + 2) for chat_id in (1, -2)]
+        self.assertEqual(model.enqueue_notifications(messages, advanced), 2)
+        # enqueueing the same batch again is a no-op
+        self.assertEqual(model.enqueue_notifications(messages, advanced), 0)
+        self.assertEqual(model.check_notifications_needed(limit=10), [])
+
+        claimed = model.claim_outbox('me', 10, 60)
+        self.assertEqual([message['chat_id'] for message in claimed],
+                         [1, -2])
+        self.assertEqual(model.claim_outbox('other', 10, 60), [])
+        self.assertEqual(model.finish_outbox('me', [
+            (claimed[0]['id'], 'sent', 1, now, None),
+            (claimed[1]['id'], 'pending', 1, now + 3600, 'timed out'),
+        ]), 2)
+        self.assertEqual(model.forget_chat(-2), 1)
+        self.assertEqual(model.prune_outbox(-10), 1)
+        self.assertEqual(model.unsubscribe_all(1), None)
+        self.assertEqual(model.collect_orphan_feeds(-10), 1)
+        self.assertFalse(model.check_feed_is_known('gig'))
+
+    def test_worker_without_shards(self):
+        model = self.model
+        model.init_feed('gig')
+        model.subscribe(1, 'gig')
+        first = model.renew_leases('w0', 0, ('fetch', 'notify'), 16, 60)
+        second = model.renew_leases('w1', 1, ('fetch', 'notify'), 16, 60)
+        self.assertEqual(len(first['fetch']), 16)
+        self.assertEqual(second['fetch'], frozenset())
+        # a worker that owns nothing yet must not break its queries
+        shards = (16, second['fetch'])
+        self.assertEqual(model.get_fetches_needed(shards=shards), [])
+        self.assertIsNone(model.get_next_fetch_time(shards=shards))
+        self.assertEqual(
+            model.check_notifications_needed(limit=10, shards=shards), []
+        )
+        self.assertEqual(model.claim_outbox('w1', 10, 60, shards=shards), [])
+        model.release_leases('w0')
+        second = model.renew_leases('w1', 1, ('fetch', 'notify'), 16, 60)
+        self.assertEqual(len(second['fetch']), 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
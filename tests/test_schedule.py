@@ -0,0 +1,43 @@
+import unittest
+
+from sbfeed_bot.schedule import SbFeedSchedule
+
+
+class ScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.schedule = SbFeedSchedule(min_interval=10, max_interval=3600,
+                                       error_interval=30,
+                                       max_error_interval=600)
+
+    def test_new_items_reset_interval(self):
+        self.assertEqual(self.schedule.next_interval(None, False, 0), 10)
+        self.assertEqual(self.schedule.next_interval(1000, True, 0), 10)
+
+    def test_quiet_feed_slows_down(self):
+        interval = None
+        intervals = []
+        for _ in range(4):
+            interval = self.schedule.next_interval(interval, False, 0)
+            intervals.append(interval)
+        self.assertEqual(intervals, [10, 15, 22, 33])
+        self.assertEqual(self.schedule.next_interval(10 ** 6, False, 0),
+                         3600)
+
+    def test_subscribers_lower_the_cap(self):
+        self.assertEqual(self.schedule.next_interval(10 ** 6, False, 1),
+                         1800)
+        self.assertEqual(self.schedule.next_interval(10 ** 6, False, 1023),
+                         327)
+        # but never below the minimum
+        self.assertEqual(self.schedule.next_interval(
+            10 ** 6, False, 2 ** 400
+        ), 10)
+
+    def test_retry_backs_off(self):
+        self.assertEqual([self.schedule.retry_interval(errors)
+                          for errors in range(1, 7)],
+                         [30, 60, 120, 240, 480, 600])
+
+
+if __name__ == '__main__':
+    unittest.main()
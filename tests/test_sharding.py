@@ -0,0 +1,97 @@
+import os
+import tempfile
+import time
+import unittest
+
+from sbfeed_bot.model import SbFeedModel, shard_key
+from sbfeed_bot.sharding import SbFeedShardLease
+
+
+class ShardingTest(unittest.TestCase):
+    def setUp(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.model = SbFeedModel(os.path.join(tmpdir.name, 'sbfeed.db'))
+        self.addCleanup(self.model.close)
+        self.model.create_db()
+
+    def lease(self, index, owner, total=4, ttl=30):
+        lease = SbFeedShardLease(self.model, index=index, total=total,
+                                 ttl=ttl)
+        lease.owner = owner
+        return lease
+
+    def test_feeds_are_filtered_by_shard(self):
+        feeds = ['feed-%d' % (index, ) for index in range(20)]
+        for feed in feeds:
+            self.model.init_feed(feed)
+        picked = []
+        for shard in range(4):
+            rows = self.model.get_fetches_needed(shards=(4, {shard}))
+            self.assertTrue(all(shard_key(row[0]) % 4 == shard
+                                for row in rows))
+            picked.extend(row[0] for row in rows)
+        self.assertEqual(sorted(picked), sorted(feeds))
+        # a worker that owns nothing yet gets nothing
+        self.assertEqual(self.model.get_fetches_needed(shards=(4, set())),
+                         [])
+        self.assertIsNone(self.model.get_next_fetch_time(shards=(4, set())))
+
+    def test_notifications_are_filtered_by_chat(self):
+        now = int(time.time())
+        self.model.init_feed('a')
+        for chat_id in (1, 2, -3):
+            self.model.subscribe(chat_id, 'a')
+        self.model.store_items('a', [{'title': 'comment', 'link': 'link',
+                                      'text': 'text', 'pubdate': now + 1}])
+        chats = lambda shards: sorted(
+            item['chat_id'] for item in
+            self.model.check_notifications_needed(shards=shards)
+        )
+        self.assertEqual(chats((2, {0})), [2])
+        self.assertEqual(chats((2, {1})), [-3, 1])
+        self.assertEqual(chats((2, set())), [])
+
+    def test_shards_are_shared_fairly(self):
+        first = self.lease(0, 'first')
+        first.renew()
+        self.assertEqual(first.shards('fetch'), (4, frozenset(range(4))))
+        second = self.lease(1, 'second')
+        # nothing is free until the first worker gives shards away
+        second.renew()
+        self.assertEqual(second.shards('notify'), (4, frozenset()))
+        first.renew()
+        second.renew()
+        for kind in SbFeedShardLease.KINDS:
+            self.assertEqual(len(first.owned[kind]), 2)
+            self.assertEqual(first.owned[kind] | second.owned[kind],
+                             frozenset(range(4)))
+
+    def test_expired_shards_are_taken_over(self):
+        self.lease(0, 'first').renew()
+        # the first worker stopped renewing its leases
+        with self.model._connection() as conn:
+            conn.execute("UPDATE shard_lease SET expires = 0 "
+                         "WHERE owner = 'first'")
+        second = self.lease(1, 'second')
+        second.renew()
+        self.assertEqual(second.owned['fetch'], frozenset(range(4)))
+
+    def test_worker_slot_is_exclusive(self):
+        self.lease(0, 'first').renew()
+        stuck = self.lease(0, 'restarted')
+        stuck.renew()
+        self.assertEqual(stuck.owned['fetch'], frozenset())
+
+    def test_release(self):
+        first = self.lease(0, 'first')
+        first.renew()
+        first.release()
+        self.assertEqual(first.owned['fetch'], frozenset())
+        second = self.lease(0, 'second')
+        second.renew()
+        self.assertEqual(second.owned['fetch'], frozenset(range(4)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,125 @@
+import json
+import threading
+import unittest
+from http.client import HTTPConnection
+
+from sbfeed_bot.webhook import SbFeedWebhook
+
+
+class FakeBot:
+    def __init__(self):
+        self.webhooks = []
+
+    def setWebhook(self, webhook_url):
+        self.webhooks.append(webhook_url)
+
+
+class FakeDispatcher:
+    def __init__(self):
+        self.bot = FakeBot()
+        self.processed = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+        self.release.set()
+        self.done = threading.Condition()
+
+    def process_update(self, update):
+        self.started.set()
+        self.release.wait(5)
+        with self.done:
+            self.processed.append(update.update_id)
+            self.done.notify_all()
+
+
+def update(update_id):
+    return json.dumps({
+        'update_id': update_id,
+        'message': {'message_id': 1, 'date': 1000000000,
+                    'chat': {'id': 1, 'type': 'private'},
+                    'text': '/start'},
+    }).encode('utf-8')
+
+
+class WebhookTest(unittest.TestCase):
+    def setUp(self):
+        self.dispatcher = FakeDispatcher()
+        self.webhook = SbFeedWebhook(
+            self.dispatcher, 'https://example.org/hook/secret', port=0,
+            workers=1, queue_size=1
+        )
+        self.webhook.start()
+        self.addCleanup(self.webhook.stop)
+        self.addCleanup(self.dispatcher.release.set)
+
+    def post(self, path, body):
+        conn = HTTPConnection('127.0.0.1',
+                              self.webhook.server.server_address[1],
+                              timeout=5)
+        self.addCleanup(conn.close)
+        conn.request('POST', path, body=body,
+                     headers={'Content-Type': 'application/json'})
+        response = conn.getresponse()
+        response.read()
+        return response
+
+    def wait_processed(self, count):
+        with self.dispatcher.done:
+            self.assertTrue(self.dispatcher.done.wait_for(
+                lambda: len(self.dispatcher.processed) >= count, timeout=5
+            ))
+
+    def test_webhook_is_set(self):
+        self.assertEqual(self.dispatcher.bot.webhooks,
+                         ['https://example.org/hook/secret'])
+
+    def test_update_is_processed(self):
+        self.assertEqual(self.post('/hook/secret', update(7)).status, 200)
+        self.wait_processed(1)
+        self.assertEqual(self.dispatcher.processed, [7])
+
+    def test_wrong_path(self):
+        self.assertEqual(self.post('/hook/guess', update(7)).status, 404)
+        self.assertEqual(self.post('/', update(7)).status, 404)
+        self.assertEqual(self.dispatcher.processed, [])
+
+    def test_malformed_update(self):
+        self.assertEqual(self.post('/hook/secret', b'{"update').status, 400)
+        self.assertEqual(self.post('/hook/secret', b'[]').status, 400)
+
+    def test_full_queue(self):
+        self.dispatcher.release.clear()
+        self.assertEqual(self.post('/hook/secret', update(1)).status, 200)
+        # the only worker is busy with the first update
+        self.assertTrue(self.dispatcher.started.wait(5))
+        self.assertEqual(self.post('/hook/secret', update(2)).status, 200)
+        response = self.post('/hook/secret', update(3))
+        self.assertEqual(response.status, 503)
+        self.assertEqual(response.getheader('Retry-After'), '1')
+        self.dispatcher.release.set()
+        self.wait_processed(2)
+        self.assertEqual(self.dispatcher.processed, [1, 2])
+
+
+class WebhookStopTest(unittest.TestCase):
+    def test_stop_with_full_queue(self):
+        webhook = SbFeedWebhook(None, 'https://example.org/secret',
+                                workers=3, queue_size=1)
+        webhook.updates.put('update')
+        stopper = threading.Thread(target=webhook.stop, daemon=True)
+        stopper.start()
+        stopper.join(5)
+        self.assertFalse(stopper.is_alive())
+
+    def test_stop_wakes_workers(self):
+        webhook = SbFeedWebhook(None, 'https://example.org/secret',
+                                workers=2, queue_size=8)
+        for worker in webhook.workers:
+            worker.start()
+        webhook.stop()
+        for worker in webhook.workers:
+            worker.join(5)
+            self.assertFalse(worker.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()